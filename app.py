@@ -3,9 +3,24 @@ import pandas as pd
 import os
 from datetime import datetime, date, timedelta
 from dateutil import parser
+import atexit
+import bisect
+import hashlib
+import heapq
+import io
+import json
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import re
-from urllib.parse import quote_plus, quote
+import sqlite3
+import threading
+import time
+from urllib.parse import quote_plus, quote, unquote
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from production_sheets import read_production_sheet, read_production_sheet_bytes
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(page_title="Insurance Marketing CRM", layout="wide")
@@ -210,227 +225,1235 @@ def load_product_highlights():
 
 PRODUCT_HIGHLIGHTS = load_product_highlights()
 
+# --- STORAGE BACKENDS ---
+STORAGE_BACKEND = os.environ.get("CRM_STORAGE", "csv").lower()  # "csv" (default) or "sqlite"
+SQLITE_PATH = os.environ.get("CRM_SQLITE_PATH", "crm.db")
+JOURNAL_COMPACT_ROWS = int(os.environ.get("CRM_JOURNAL_COMPACT_ROWS", "5000"))  # fold journal into base file past this
+WATCH_INTERVAL_SECONDS = float(os.environ.get("CRM_WATCH_INTERVAL", "5"))  # 0 disables the file watcher
+DROP_DIR = os.environ.get("CRM_DROP_DIR", "")  # production workbooks saved here are imported in the background; "" disables
+DROP_INTERVAL_SECONDS = float(os.environ.get("CRM_DROP_INTERVAL", "30"))
+DROP_SETTLE_SECONDS = float(os.environ.get("CRM_DROP_SETTLE", "5"))  # left unmodified this long before a dropped file is read
+WRITE_DELAY_SECONDS = float(os.environ.get("CRM_WRITE_DELAY", "2"))  # max time a save waits in the queue; 0 writes inline
+LOG_PARTITION_DIR = os.environ.get("CRM_LOG_DIR", "crm_logs")  # one CSV per month, e.g. crm_logs/2025-11.csv
+LOG_MIGRATED_FILE = "crm_logs.migrated.csv"  # the single crm_logs.csv, renamed once split into partitions
+LOG_HOT_DAYS = 90  # besides the current year, keep at least this many days of logs in memory
+PRODUCTION_DIR = os.environ.get("CRM_PRODUCTION_DIR", "crm_production")  # Parquet dataset, Office=<code>/Month=<YYYY-MM>/
+PRODUCTION_CSV_MARKER = "crm_production.imported.json"  # what crm_production.csv held when last imported
+ID_MARKS_FILE = "crm_ids.json"  # highest ID ever issued per ID column (CSV storage)
+# Typed columns stored in each partition file (Office and Month live in the directory names)
+PRODUCTION_FILE_SCHEMA = pa.schema([
+    ('AgencyCode', pa.string()),
+    ('AgencyName', pa.string()),
+    ('ActiveFlag', pa.string()),
+    ('AllYTDWP', pa.float64()),
+    ('AllYTDNB', pa.int64()),
+    ('PYTDWP', pa.float64()),
+    ('PYTDNB', pa.int64()),
+    ('PYTotalNB', pa.int64()),
+])
+
+# Columns identifying a row; lets the SQLite backend turn a changed row into an UPDATE
+TABLE_KEYS = {
+    'offices': ['OfficeName'],
+    'employees': ['EmployeeID'],
+    'agencies': ['AgencyID'],
+    'contacts': ['ContactID'],
+    'logs': [],
+    'production': ['Office', 'Month', 'AgencyCode'],
+    'tasks': ['TaskID'],
+}
+
+# Column types per table, applied once when a table is read (apply_schema):
+#   text  -> str, missing as ""
+#   code  -> text with any float artefact dropped ("8582752385.0" -> "8582752385") and stripped
+#   category -> text held as a pandas categorical (low-cardinality columns of the large tables)
+#   int -> int32, float -> float64, missing as 0
+#   datetime -> datetime64, unparseable as NaT
+TABLE_SCHEMAS = {
+    'offices': {'OfficeName': 'text'},
+    'employees': {'EmployeeID': 'int', 'Name': 'text', 'Office': 'text'},
+    'agencies': {
+        'AgencyID': 'int', 'AgencyName': 'text', 'Office': 'text', 'WebAddress': 'text',
+        'AgencyCode': 'code', 'Notes': 'text', 'PrimaryUnderwriter': 'text',
+    },
+    'contacts': {
+        'ContactID': 'int', 'AgencyID': 'int', 'Name': 'text', 'Role': 'text', 'Email': 'text',
+        'Phone': 'code', 'Notes': 'text', 'Preferences': 'text', 'LinkedIn': 'text',
+    },
+    # Logs reference employees, agencies and contacts by ID; the name columns keep the names
+    # as they were when the activity was logged (display uses the current names, see find_logs)
+    'logs': {
+        'Date': 'datetime', 'EmployeeID': 'int', 'AgencyID': 'int', 'ContactID': 'int',
+        'Type': 'category', 'Notes': 'text',
+        'EmployeeName': 'category', 'AgencyName': 'category', 'ContactName': 'category',
+    },
+    'production': {
+        'AgencyCode': 'code', 'AgencyName': 'category', 'Office': 'category', 'Month': 'category',
+        'ActiveFlag': 'category',
+        'AllYTDWP': 'float', 'AllYTDNB': 'int', 'PYTDWP': 'float', 'PYTDNB': 'int', 'PYTotalNB': 'int',
+    },
+    'tasks': {
+        'TaskID': 'int', 'AgencyID': 'int', 'Title': 'text', 'DueDate': 'text', 'Status': 'text',
+        'Owner': 'text', 'Notes': 'text',
+    },
+}
+# In-memory helper columns computed from stored ones; never written (see table_frame)
+DERIVED_COLUMNS = {'production': ['Month_dt']}
+LOG_COLUMNS = list(TABLE_SCHEMAS['logs'])
+# Log reference column -> (logged name column, referenced table, its name column)
+LOG_REFERENCES = {
+    'EmployeeID': ('EmployeeName', 'employees', 'Name'),
+    'AgencyID': ('AgencyName', 'agencies', 'AgencyName'),
+    'ContactID': ('ContactName', 'contacts', 'Name'),
+}
+PRODUCTION_COLUMNS = list(TABLE_SCHEMAS['production'])
+
+def csv_dtypes(key):
+    """read_csv dtype map keeping text and code columns as strings (no float inference for phones/codes)."""
+    return {col: str for col, kind in TABLE_SCHEMAS[key].items() if kind in ('text', 'code', 'category')}
+
+def apply_schema(key, df):
+    """
+    Give df every column of the table's schema with its declared type, then add the
+    derived columns. Extra columns are kept as they are.
+    """
+    df = df.copy()
+    for col, kind in TABLE_SCHEMAS[key].items():
+        values = df[col] if col in df.columns else pd.Series(np.nan, index=df.index, dtype=object)
+        if kind in ('text', 'code', 'category'):
+            values = values.astype(object).fillna("").astype(str)
+            if kind == 'code':
+                values = values.str.replace(r"\.0$", "", regex=True).str.strip()
+            elif kind == 'category':
+                values = values.astype('category')
+        elif kind == 'int':
+            values = pd.to_numeric(values, errors='coerce').fillna(0).astype('int32')
+        elif kind == 'float':
+            values = pd.to_numeric(values, errors='coerce').fillna(0.0).astype(float)
+        elif kind == 'datetime':
+            values = pd.to_datetime(values, errors='coerce')
+        df[col] = values
+    return add_derived_columns(key, df)
+
+def compact_frame(key, df):
+    """
+    Re-narrow a table after edits: concatenating or editing rows can widen categoricals to
+    strings and int32 to int64. Columns already in their compact dtype are left alone.
+    """
+    if not isinstance(df, pd.DataFrame):
+        return df
+    casts = {}
+    for col, kind in TABLE_SCHEMAS[key].items():
+        if col not in df.columns:
+            continue
+        if kind == 'category' and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            casts[col] = 'category'
+        elif kind == 'int' and df[col].dtype != np.int32 and pd.api.types.is_integer_dtype(df[col]):
+            casts[col] = 'int32'
+    return df.astype(casts) if casts else df
+
+def memory_report(tables):
+    """
+    Per-table memory in MB as loaded (compact dtypes) and as it would be with plain
+    object strings and int64 for the columns declared as category or int.
+    """
+    rows = []
+    for key, table in tables.items():
+        if not isinstance(table, pd.DataFrame):
+            continue
+        plain = table.astype({
+            col: object if kind == 'category' else 'int64'
+            for col, kind in TABLE_SCHEMAS[key].items()
+            if col in table.columns and kind in ('category', 'int')
+        })
+        before = plain.memory_usage(deep=True).sum() / 2**20
+        after = table.memory_usage(deep=True).sum() / 2**20
+        rows.append({
+            'Table': key,
+            'Rows': len(table),
+            'Before (MB)': round(before, 2),
+            'After (MB)': round(after, 2),
+            'Saved': f"{1 - after / before:.0%}" if before else "",
+        })
+    return pd.DataFrame(rows)
+
+def add_derived_columns(key, df):
+    if key == 'production':
+        df = df.assign(Month_dt=pd.to_datetime(df['Month'].astype(object), format="%Y-%m", errors='coerce'))
+    return df
+
+def table_frame(key, value):
+    """Return a table as stored: a DataFrame (offices are kept in memory as a plain list) without derived columns."""
+    if key == 'offices' and not isinstance(value, pd.DataFrame):
+        return pd.DataFrame({'OfficeName': list(value)})
+    derived = [c for c in DERIVED_COLUMNS.get(key, []) if c in value.columns]
+    return value.drop(columns=derived) if derived else value
+
+def to_storage_frame(df):
+    """Copy of df with datetimes as text and missing values as None, ready for sqlite3."""
+    out = df.copy()
+    for col in out.columns:
+        if pd.api.types.is_datetime64_any_dtype(out[col]):
+            out[col] = out[col].dt.strftime("%Y-%m-%d %H:%M:%S")
+        elif pd.api.types.is_float_dtype(out[col]) and (out[col].dropna() % 1 == 0).all():
+            # Whole numbers that became float because of a missing value (IDs, codes, phones)
+            out[col] = out[col].astype('Int64')
+    out = out.astype(object)
+    return out.where(out.notna(), None)
+
+def row_hashes(stored):
+    """Stable 64-bit hash per row of a storage frame."""
+    return pd.util.hash_pandas_object(stored.astype(str), index=False).to_numpy().view('int64')
+
+def hash_occurrences(hashes):
+    """(hash, occurrence) per row, so identical rows pair up one-to-one between two versions of a table."""
+    hashes = pd.Series(hashes).reset_index(drop=True)
+    return pd.MultiIndex.from_arrays([hashes, hashes.groupby(hashes).cumcount()])
+
+def file_signature(path):
+    """(mtime, size, inode) of a file, or None if it does not exist."""
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (info.st_mtime_ns, info.st_size, info.st_ino)
+
+def hot_log_start(today=None):
+    """
+    First day of the oldest month of activity loaded at startup: January 1st, or earlier
+    if needed to cover the last LOG_HOT_DAYS (30-day dashboards and 90-day outreach checks).
+    """
+    today = today or datetime.now().date()
+    start = min(date(today.year, 1, 1), today - timedelta(days=LOG_HOT_DAYS))
+    return pd.Timestamp(start.year, start.month, 1)
+
+def log_date_mask(logs, since=None, before=None):
+    """Boolean mask of log rows with since <= Date < before."""
+    dates = pd.to_datetime(logs['Date'], errors='coerce')
+    mask = pd.Series(True, index=logs.index)
+    if since is not None:
+        mask &= dates >= since
+    if before is not None:
+        mask &= dates < before
+    return mask
+
+def period_mask(df, periods):
+    """Rows of df whose (Office, Month) is one of `periods`."""
+    if df.empty or not periods:
+        return np.zeros(len(df), dtype=bool)
+    keys = pd.MultiIndex.from_arrays([df['Office'].astype(object), df['Month'].astype(object)])
+    return keys.isin(list(periods))
+
+def journal_path(key):
+    """Append-only journal next to a table's CSV, e.g. crm_logs.journal.csv."""
+    base, ext = os.path.splitext(FILES[key])
+    return f"{base}.journal{ext}"
+
+class ProductionDataset:
+    """
+    Production history as a Parquet dataset with one file per Office/Month partition
+    (crm_production/Office=SDO/Month=2025-11/part.parquet). Reads are memory-mapped, and
+    saves rewrite only the partitions whose rows changed.
+    """
+    def __init__(self, root=PRODUCTION_DIR):
+        self.root = root
+        # Content hash of each partition as of our last full read or write; save() skips unchanged ones
+        self.partition_hashes = {}
+
+    def exists(self):
+        return os.path.isdir(self.root)
+
+    def normalize(self, df):
+        """df with exactly the stored columns, typed by the production schema and with text stripped."""
+        df = apply_schema('production', df)[PRODUCTION_COLUMNS]
+        for col, kind in TABLE_SCHEMAS['production'].items():
+            if kind in ('text', 'category'):
+                df[col] = df[col].astype(object).str.strip()
+        return df
+
+    def _path(self, office, month):
+        return os.path.join(
+            self.root, f"Office={quote(office, safe='')}", f"Month={quote(month, safe='')}", "part.parquet"
+        )
+
+    def _files(self):
+        """{(office, month): path} for every partition on disk."""
+        files = {}
+        if not self.exists():
+            return files
+        for office_dir in sorted(os.listdir(self.root)):
+            if not office_dir.startswith("Office="):
+                continue
+            for month_dir in sorted(os.listdir(os.path.join(self.root, office_dir))):
+                path = os.path.join(self.root, office_dir, month_dir, "part.parquet")
+                if month_dir.startswith("Month=") and os.path.exists(path):
+                    files[(unquote(office_dir[7:]), unquote(month_dir[6:]))] = path
+        return files
+
+    def signature(self):
+        return tuple((part, file_signature(path)) for part, path in self._files().items())
+
+    def read(self):
+        frames = []
+        for (part_office, part_month), path in self._files().items():
+            table = pq.read_table(path, schema=PRODUCTION_FILE_SCHEMA, memory_map=True)
+            if table.num_rows:
+                frame = table.to_pandas()
+                frame['Office'] = part_office
+                frame['Month'] = part_month
+                frames.append(frame)
+        if not frames:
+            return self.normalize(pd.DataFrame(columns=PRODUCTION_COLUMNS))
+        df = pd.concat(frames, ignore_index=True)[PRODUCTION_COLUMNS]
+        self.partition_hashes = self._hashes(df)
+        return df
+
+    def _hashes(self, df):
+        if df.empty:
+            return {}
+        row_hash = pd.util.hash_pandas_object(df, index=False)
+        return row_hash.groupby([df['Office'], df['Month']], observed=True).sum().to_dict()
+
+    def save(self, df):
+        """Rewrite only the partitions whose rows changed; drop partitions that no longer have rows."""
+        df = self.normalize(df)
+        hashes = self._hashes(df)
+        for (office, month), rows in df.groupby(['Office', 'Month'], sort=False, observed=True):
+            if self.partition_hashes.get((office, month)) != hashes[(office, month)]:
+                self._write_partition(office, month, rows)
+        for part, path in self._files().items():
+            if part not in hashes:
+                os.remove(path)
+                os.rmdir(os.path.dirname(path))
+        self.partition_hashes = hashes
+
+    def write(self, df):
+        self.partition_hashes = {}
+        os.makedirs(self.root, exist_ok=True)
+        self.save(df)
+
+    def save_periods(self, df, periods):
+        """Rewrite only the (office, month) partitions in `periods` from df's rows; a period with no rows is removed."""
+        rows = self.normalize(df[period_mask(df, periods)])
+        hashes = self._hashes(rows)
+        by_period = dict(tuple(rows.groupby(['Office', 'Month'], sort=False, observed=True)))
+        for office, month in periods:
+            path = self._path(office, month)
+            if (office, month) in by_period:
+                self._write_partition(office, month, by_period[(office, month)])
+                self.partition_hashes[(office, month)] = hashes[(office, month)]
+            elif os.path.exists(path):
+                os.remove(path)
+                os.rmdir(os.path.dirname(path))
+                self.partition_hashes.pop((office, month), None)
+
+    def _write_partition(self, office, month, rows):
+        path = self._path(office, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table = pa.Table.from_pandas(
+            rows[PRODUCTION_FILE_SCHEMA.names], schema=PRODUCTION_FILE_SCHEMA, preserve_index=False
+        )
+        tmp_path = path + ".tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+class FileBackend:
+    """
+    One CSV file per table (the original storage format, also used for import/export).
+    Appends go to a per-table journal file that is folded back into the base file by compact().
+    The activity log is stored as one CSV per month under LOG_PARTITION_DIR so that only
+    recent months need to be read at startup, and production as a ProductionDataset.
+    """
+    name = "csv"
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.journal_rows = {}
+        self.production = ProductionDataset()
+        # Signature of each table after this process last wrote or read it (see TableWatcher)
+        self.known_signatures = {}
+        self.id_marks = None  # see issued_id_marks
+
+    def _partitioned(self, key):
+        return key == 'logs'
+
+    def signature(self, key):
+        if self._partitioned(key):
+            parts = tuple((month, file_signature(path)) for month, path in self._partition_files().items())
+            return (parts, file_signature(journal_path(key)))
+        if key == 'production':
+            return (self.production.signature(), file_signature(FILES[key]))
+        return (file_signature(FILES[key]), file_signature(journal_path(key)))
+
+    def mark_seen(self, key):
+        self.known_signatures[key] = self.signature(key)
+
+    def refresh(self, key):
+        # The CSV file is the table; nothing to import
+        pass
+
+    def exists(self, key):
+        if self._partitioned(key) and os.path.isdir(LOG_PARTITION_DIR):
+            return True
+        if key == 'production' and self.production.exists():
+            return True
+        return os.path.exists(FILES[key]) or os.path.exists(journal_path(key))
+
+    def read(self, key):
+        if self._partitioned(key):
+            return self.read_logs()
+        if key == 'production':
+            return self.read_production()
+        with self.lock:
+            frames = [pd.read_csv(path, dtype=csv_dtypes(key)) for path in (FILES[key], journal_path(key)) if os.path.exists(path)]
+            if os.path.exists(journal_path(key)):
+                self.journal_rows[key] = len(frames[-1])
+            self.mark_seen(key)
+        return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+    def write(self, key, df):
+        with self.lock:
+            if self._partitioned(key):
+                self._write_partitions(df, replace_from="")
+            elif key == 'production':
+                self.production.write(df)
+            else:
+                table_frame(key, df).to_csv(FILES[key], index=False)
+            # A full write already contains everything the journal held
+            if os.path.exists(journal_path(key)):
+                os.remove(journal_path(key))
+            self.journal_rows[key] = 0
+            self.mark_seen(key)
+
+    def save(self, key, df):
+        if key == 'production':
+            with self.lock:
+                self.production.save(df)
+                self.mark_seen(key)
+            return
+        # CSV has no row-level update; every save rewrites the file
+        self.write(key, df)
+
+    def append(self, key, df):
+        """Append rows to the table's journal with a single fsync for the batch."""
+        path = journal_path(key)
+        with self.lock:
+            # Log partitions are aligned by column name when the journal is folded in
+            header_source = path if os.path.exists(path) or self._partitioned(key) else FILES[key]
+            new_file = not os.path.exists(path)
+            if os.path.exists(header_source):
+                df = df.reindex(columns=pd.read_csv(header_source, nrows=0).columns)
+            with open(path, "a", newline="", encoding="utf-8") as f:
+                df.to_csv(f, header=new_file, index=False)
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal_rows[key] = self.journal_rows.get(key, 0) + len(df)
+            self.mark_seen(key)
+            if self.journal_rows[key] >= JOURNAL_COMPACT_ROWS:
+                self.compact(key)
+
+    def compact(self, key):
+        """Fold the journal into the base file (written to a temp file, then swapped in)."""
+        path = journal_path(key)
+        with self.lock:
+            if self._partitioned(key):
+                self._migrate_legacy_logs()
+            if not os.path.exists(path):
+                return
+            if self._partitioned(key):
+                # Only the months that received journaled rows are rewritten
+                journal = pd.read_csv(path, dtype=csv_dtypes(key))
+                months = pd.to_datetime(journal['Date'], errors='coerce').dt.strftime("%Y-%m")
+                partitions = self._partition_files()
+                for month, rows in journal.groupby(months):
+                    if month in partitions:
+                        rows = pd.concat([pd.read_csv(partitions[month], dtype=csv_dtypes(key)), rows], ignore_index=True)
+                    self._write_csv_atomic(rows, os.path.join(LOG_PARTITION_DIR, f"{month}.csv"))
+            else:
+                self._write_csv_atomic(self.read(key), FILES[key])
+            os.remove(path)
+            self.journal_rows[key] = 0
+            self.mark_seen(key)
+
+    # --- monthly log partitions ---
+    def _write_csv_atomic(self, df, path):
+        tmp_path = path + ".tmp"
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+    def _partition_files(self):
+        """{'YYYY-MM': path} for every monthly log partition on disk."""
+        if not os.path.isdir(LOG_PARTITION_DIR):
+            return {}
+        return {
+            name[:-4]: os.path.join(LOG_PARTITION_DIR, name)
+            for name in sorted(os.listdir(LOG_PARTITION_DIR))
+            if re.fullmatch(r"\d{4}-\d{2}\.csv", name)
+        }
+
+    def _write_partitions(self, df, replace_from=None):
+        """Write logs grouped by month; partitions from `replace_from` on that get no rows are removed."""
+        os.makedirs(LOG_PARTITION_DIR, exist_ok=True)
+        dates = pd.to_datetime(df['Date'], errors='coerce')
+        valid = dates.notna()
+        written = set()
+        for month, rows in df[valid].groupby(dates[valid].dt.strftime("%Y-%m")):
+            self._write_csv_atomic(rows, os.path.join(LOG_PARTITION_DIR, f"{month}.csv"))
+            written.add(month)
+        if replace_from is not None:
+            for month, path in self._partition_files().items():
+                if month >= replace_from and month not in written:
+                    os.remove(path)
+
+    def _migrate_legacy_logs(self):
+        """
+        One-shot split of a single crm_logs.csv into monthly partitions. The file is then renamed
+        to LOG_MIGRATED_FILE: it is no longer written, so it must not look like the live log.
+        """
+        if not os.path.isdir(LOG_PARTITION_DIR) and os.path.exists(FILES['logs']):
+            self._write_partitions(pd.read_csv(FILES['logs'], dtype=csv_dtypes('logs')))
+            os.replace(FILES['logs'], LOG_MIGRATED_FILE)
+
+    def read_logs(self, since=None, before=None):
+        """Logs with since <= Date < before, reading only the partitions in that range."""
+        with self.lock:
+            self._migrate_legacy_logs()
+            low = since.strftime("%Y-%m") if since is not None else None
+            high = before.strftime("%Y-%m") if before is not None else None
+            frames = [
+                pd.read_csv(path, dtype=csv_dtypes('logs'))
+                for month, path in self._partition_files().items()
+                if (low is None or month >= low) and (high is None or month < high)
+            ]
+            if os.path.exists(journal_path('logs')):
+                journal = pd.read_csv(journal_path('logs'), dtype=csv_dtypes('logs'))
+                self.journal_rows['logs'] = len(journal)
+                frames.append(journal[log_date_mask(journal, since, before)])
+            self.mark_seen('logs')
+            if not frames:
+                # No rows in range; keep the stored columns (load_logs checks them)
+                partitions = self._partition_files()
+                if partitions:
+                    return pd.read_csv(list(partitions.values())[-1], dtype=csv_dtypes('logs'), nrows=0)
+                return pd.DataFrame(columns=LOG_COLUMNS)
+        return pd.concat(frames, ignore_index=True)
+
+    def save_logs(self, df, since):
+        """Replace the stored logs dated on/after `since` with df, leaving older months untouched."""
+        with self.lock:
+            self.compact('logs')
+            recent = df[log_date_mask(df, since, None)]
+            self._write_partitions(recent, replace_from=since.strftime("%Y-%m"))
+            self.mark_seen('logs')
+
+    def has_logs_before(self, since):
+        self._migrate_legacy_logs()
+        return any(month < since.strftime("%Y-%m") for month in self._partition_files())
+
+    # --- production dataset ---
+    def read_production(self):
+        """The whole production table, after merging in any outside edits to crm_production.csv."""
+        with self.lock:
+            changes = self.production_csv_changes(import_all=not self.production.exists())
+            if changes is not None:
+                self.production.save_periods(*changes)
+            df = self.production.read()
+            self.mark_seen('production')
+        return df
+
+    def save_production_periods(self, df, periods):
+        """Replace the stored rows of the given (office, month) periods with df's; other partitions are untouched."""
+        with self.lock:
+            self.production.save_periods(df, periods)
+            self.mark_seen('production')
+
+    def production_csv_changes(self, import_all):
+        """
+        (rows, periods) for the (Office, Month) periods whose rows in crm_production.csv changed
+        since the file was last looked at, or None. Imports only go to the production store,
+        so the CSV may be stale: periods it does not change (or no longer has) are left alone.
+        What the file held, as one hash per period, is kept in PRODUCTION_CSV_MARKER. With no
+        marker, every period counts as changed when import_all (nothing imported yet), and
+        otherwise the file is only recorded.
+        """
+        signature = file_signature(FILES['production'])
+        if signature is None:
+            return None
+        try:
+            with open(PRODUCTION_CSV_MARKER) as f:
+                marker = json.load(f)
+        except (OSError, ValueError):
+            marker = None
+        if marker is not None and tuple(marker.get('signature', ())) == signature:
+            return None
+        rows = self.production.normalize(pd.read_csv(FILES['production'], dtype=csv_dtypes('production')))
+        hashes = {f"{office}\t{month}": str(int(h)) for (office, month), h in self.production._hashes(rows).items()}
+        if marker is not None:
+            known = marker.get('periods', {})
+            changed = [part for part, h in hashes.items() if known.get(part) != h]
+        else:
+            changed = list(hashes) if import_all else []
+        with open(PRODUCTION_CSV_MARKER, "w") as f:
+            json.dump({'signature': list(signature), 'periods': hashes}, f)
+        if not changed:
+            return None
+        return rows, {tuple(part.split("\t", 1)) for part in changed}
+
+    # --- issued IDs ---
+    def read_id_marks(self):
+        try:
+            with open(ID_MARKS_FILE) as f:
+                return {col: int(high) for col, high in json.load(f).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def save_id_marks(self, marks):
+        with open(ID_MARKS_FILE, "w") as f:
+            json.dump(marks, f)
+
+class SqliteBackend:
+    """
+    All tables in one SQLite database. Saves diff the in-memory table against the stored
+    rows and apply only the changed rows as INSERT/UPDATE/DELETE inside one transaction.
+    """
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.lock = threading.RLock()
+        self.csv = FileBackend()
+        self.known_signatures = {}
+        self.id_marks = None  # see issued_id_marks
+
+    # The crm_*.csv files remain the import channel: an external edit to one is
+    # detected through its signature and imported by refresh().
+    def signature(self, key):
+        return self.csv.signature(key)
+
+    def mark_seen(self, key):
+        self.known_signatures[key] = self.signature(key)
+
+    def refresh(self, key):
+        """Re-import a table from its CSV file after an external edit."""
+        if key == 'production':
+            # Only the periods the CSV edit changed; imports made here are not in that file
+            changes = self.csv.production_csv_changes(import_all=not self.exists('production'))
+            if changes is not None:
+                rows, periods = changes
+                current = self.read('production') if self.exists('production') else rows.iloc[:0]
+                merged = pd.concat([current[~period_mask(current, periods)], rows[period_mask(rows, periods)]], ignore_index=True)
+                self.save_production_periods(merged, periods)
+        elif self.csv.exists(key):
+            self.write(key, self.csv.read(key))
+        self.mark_seen(key)
+
+    def read_id_marks(self):
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS id_marks (id_col TEXT PRIMARY KEY, high INTEGER)')
+            return dict(self.conn.execute('SELECT id_col, high FROM id_marks').fetchall())
+
+    def save_id_marks(self, marks):
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS id_marks (id_col TEXT PRIMARY KEY, high INTEGER)')
+            self.conn.executemany('INSERT OR REPLACE INTO id_marks VALUES (?, ?)', list(marks.items()))
+
+    def _columns(self, key):
+        with self.lock:
+            rows = self.conn.execute(f'PRAGMA table_info("{key}")').fetchall()
+        return [r[1] for r in rows if r[1] != '_rowhash']
+
+    def exists(self, key):
+        return bool(self._columns(key))
+
+    def read(self, key):
+        col_sql = ", ".join(f'"{c}"' for c in self._columns(key))
+        with self.lock:
+            return pd.read_sql_query(f'SELECT {col_sql} FROM "{key}" ORDER BY rowid', self.conn)
+
+    def _insert(self, key, stored, hashes):
+        col_sql = ", ".join(f'"{c}"' for c in stored.columns)
+        placeholders = ", ".join("?" * (len(stored.columns) + 1))
+        rows = [
+            values + (int(h),)
+            for values, h in zip(stored.itertuples(index=False, name=None), hashes)
+        ]
+        self.conn.executemany(
+            f'INSERT INTO "{key}" ({col_sql}, _rowhash) VALUES ({placeholders})', rows
+        )
+
+    def write(self, key, df):
+        """Replace the whole table in one transaction."""
+        stored = to_storage_frame(table_frame(key, df))
+        col_sql = ", ".join(f'"{c}"' for c in stored.columns)
+        with self.lock, self.conn:
+            self.conn.execute(f'DROP TABLE IF EXISTS "{key}"')
+            self.conn.execute(f'CREATE TABLE "{key}" ({col_sql}, _rowhash INTEGER)')
+            if key == 'logs':
+                self.conn.execute('CREATE INDEX logs_date ON logs ("Date")')
+            elif key == 'production':
+                self.conn.execute('CREATE INDEX production_office ON production ("Office", "Month")')
+            self._insert(key, stored, row_hashes(stored))
+
+    def append(self, key, df):
+        """Insert new rows in one transaction."""
+        cols = self._columns(key)
+        if set(cols) != {str(c) for c in df.columns}:
+            self.save(key, pd.concat([self.read(key), df], ignore_index=True) if cols else df)
+            return
+        stored = to_storage_frame(df[cols]).reset_index(drop=True)
+        with self.lock, self.conn:
+            self._insert(key, stored, row_hashes(stored))
+
+    def compact(self, key):
+        # Appends are already row inserts; nothing to fold
+        pass
+
+    def read_logs(self, since=None, before=None):
+        """Logs with since <= Date < before (ISO date text compares in date order)."""
+        col_sql = ", ".join(f'"{c}"' for c in self._columns('logs'))
+        where, params = self._date_range_sql(since, before)
+        with self.lock:
+            return pd.read_sql_query(
+                f'SELECT {col_sql} FROM logs WHERE {where} ORDER BY rowid', self.conn, params=params
+            )
+
+    def _date_range_sql(self, since, before):
+        clauses, params = ["1"], []
+        if since is not None:
+            clauses.append('"Date" >= ?')
+            params.append(since.strftime("%Y-%m-%d %H:%M:%S"))
+        if before is not None:
+            clauses.append('"Date" < ?')
+            params.append(before.strftime("%Y-%m-%d %H:%M:%S"))
+        return " AND ".join(clauses), params
+
+    def save_logs(self, df, since):
+        """Diff df against the stored logs dated on/after `since`; older rows are untouched."""
+        recent = df[log_date_mask(df, since, None)]
+        if self._columns('logs') != [str(c) for c in df.columns]:
+            self.write('logs', pd.concat([self.read_logs(before=since), recent], ignore_index=True))
+            return
+        where, params = self._date_range_sql(since, None)
+        self.save('logs', recent, where=where, params=params)
+
+    def has_logs_before(self, since):
+        where, params = self._date_range_sql(None, since)
+        with self.lock:
+            return self.conn.execute(f'SELECT 1 FROM logs WHERE {where} LIMIT 1', params).fetchone() is not None
+
+    def save_production_periods(self, df, periods):
+        """Diff df's rows for the given (office, month) periods against the stored ones, in one transaction."""
+        if not periods:
+            return
+        if self._columns('production') != [str(c) for c in table_frame('production', df).columns]:
+            self.save('production', df)  # new table or changed columns: full write
+            return
+        where = " OR ".join('("Office" = ? AND "Month" = ?)' for _ in periods)
+        params = [value for period in periods for value in period]
+        self.save('production', df[period_mask(df, periods)], where=where, params=params)
+
+    def save(self, key, df, where="1", params=()):
+        """Write only the rows of df that differ from the stored rows matching `where`."""
+        df = table_frame(key, df)
+        if self._columns(key) != [str(c) for c in df.columns]:
+            # New table or changed columns: nothing to diff against
+            self.write(key, df)
+            return
+
+        stored = to_storage_frame(df).reset_index(drop=True)
+        new_h = pd.Series(row_hashes(stored))
+        keys = TABLE_KEYS.get(key, [])
+        key_sql = "".join(f', "{c}"' for c in keys)
+        with self.lock, self.conn:
+            old = pd.read_sql_query(
+                f'SELECT rowid AS _rid, _rowhash{key_sql} FROM "{key}" WHERE {where}', self.conn, params=params
+            )
+
+            # Pair identical rows one-to-one (duplicates included) by (hash, occurrence)
+            new_ids = hash_occurrences(new_h)
+            old_ids = hash_occurrences(old['_rowhash'])
+            inserts = stored[~new_ids.isin(old_ids)]
+            deletes = old[~old_ids.isin(new_ids)]
+
+            # A removed and an added row sharing a unique key become one UPDATE
+            updates = []
+            if keys and not inserts.empty and not deletes.empty:
+                ins_keys = inserts[keys].astype(str).agg("\x1f".join, axis=1)
+                del_keys = deletes[keys].astype(str).agg("\x1f".join, axis=1)
+                ins_keys = ins_keys[~ins_keys.duplicated(keep=False)]
+                del_keys = del_keys[~del_keys.duplicated(keep=False)]
+                rowid_by_key = dict(zip(del_keys, deletes.loc[del_keys.index, '_rid']))
+                paired = ins_keys[ins_keys.isin(rowid_by_key.keys())]
+                updates = [(label, rowid_by_key[k]) for label, k in paired.items()]
+
+            updated_labels = {label for label, _ in updates}
+            updated_rowids = {rowid for _, rowid in updates}
+            if updates:
+                set_sql = ", ".join(f'"{c}" = ?' for c in stored.columns)
+                self.conn.executemany(
+                    f'UPDATE "{key}" SET {set_sql}, _rowhash = ? WHERE rowid = ?',
+                    [
+                        tuple(stored.loc[label]) + (int(new_h[label]), int(rowid))
+                        for label, rowid in updates
+                    ],
+                )
+            self.conn.executemany(
+                f'DELETE FROM "{key}" WHERE rowid = ?',
+                [(int(r),) for r in deletes['_rid'] if r not in updated_rowids],
+            )
+            remaining = inserts[~inserts.index.isin(list(updated_labels))]
+            self._insert(key, remaining, new_h[remaining.index])
+
+def migrate_csv_to_sqlite(backend):
+    """One-shot import of the existing crm_*.csv files into tables the database does not have yet."""
+    migrated = []
+    for key in FILES:
+        if backend.csv.exists(key) and not backend.exists(key):
+            backend.write(key, backend.csv.read(key))
+            migrated.append(key)
+        backend.mark_seen(key)
+    return migrated
+
+@st.cache_resource
+def get_storage_backend():
+    """Process-wide storage backend chosen by CRM_STORAGE (set CRM_STORAGE=sqlite to enable SQLite)."""
+    if STORAGE_BACKEND == "sqlite":
+        backend = SqliteBackend(SQLITE_PATH)
+        migrate_csv_to_sqlite(backend)
+        return backend
+    return FileBackend()
+
+def export_tables_to_csv():
+    """Write every table to its crm_*.csv file (one flat file per table, logs with their full history)."""
+    backend = get_storage_backend()
+    get_data_store().writer.flush()
+    for key in FILES:
+        # The session holds only recent logs; export the full history
+        table = backend.read_logs() if key == 'logs' else st.session_state[key]
+        table_frame(key, table).to_csv(FILES[key], index=False)
+        # Our own export is not an external edit for the watcher to re-import
+        backend.mark_seen(key)
+
 # --- LOAD / SAVE FUNCTIONS ---
+ID_MARKS_LOCK = threading.Lock()
+
+def issued_id_marks(backend):
+    """{ID column: highest ID ever issued}, read from the backend on first use."""
+    with ID_MARKS_LOCK:
+        if backend.id_marks is None:
+            backend.id_marks = backend.read_id_marks()
+        return dict(backend.id_marks)
+
+def note_issued_ids(backend, key, df):
+    """Raise the high-water mark of a table's ID column to df's highest ID (it never goes down)."""
+    keys = TABLE_KEYS.get(key, [])
+    id_col = keys[0] if len(keys) == 1 else ""
+    if not id_col.endswith('ID') or df.empty:
+        return
+    high = pd.to_numeric(df[id_col], errors='coerce').max()
+    if pd.isna(high):
+        return
+    issued_id_marks(backend)
+    with ID_MARKS_LOCK:
+        if int(high) > backend.id_marks.get(id_col, 0):
+            backend.id_marks[id_col] = int(high)
+            backend.save_id_marks(backend.id_marks)
+
 def get_new_id(df, id_col):
-    """Helper to generate a unique ID."""
-    if df.empty:
-        return 1
-    return df[id_col].max() + 1
+    """
+    Helper to generate a unique ID: past both df's highest ID and the highest ever issued,
+    so the ID of a deleted record (which old logs may still name) is never handed out again.
+    """
+    issued = issued_id_marks(get_storage_backend()).get(id_col, 0)
+    current = 0 if df.empty else df[id_col].max()
+    return max(current, issued) + 1
 
-def save_to_csv(key):
-    """Saves the specific dataframe back to its CSV file."""
-    if key == 'offices':
-        df = pd.DataFrame({'OfficeName': st.session_state['offices']})
-        df.to_csv(FILES['offices'], index=False)
-    elif key == 'tasks':
-        st.session_state[key].to_csv(FILES[key], index=False)
-    else:
-        st.session_state[key].to_csv(FILES[key], index=False)
+def with_unique_ids(df, id_col):
+    """
+    df with every repeat of an ID after its first row given a new ID past the current maximum,
+    so that the ID can be joined on. Returns (df, number of rows renumbered).
+    """
+    repeated = df[id_col].duplicated()
+    count = int(repeated.sum())
+    if not count:
+        return df, 0
+    df = df.copy()
+    start = get_new_id(df, id_col)
+    df.loc[repeated, id_col] = np.arange(start, start + count).astype(df[id_col].dtype)
+    return df, count
+
+def employee_ids(employees):
+    """Each employee's ID as logs reference it: the lowest EmployeeID among their office rows."""
+    if employees.empty:
+        return {}
+    return employees.groupby('Name')['EmployeeID'].min().to_dict()
 
-def load_data():
+def employee_office_rows(employees, name, offices):
     """
-    Loads data from CSVs, ensuring all required columns exist and handling NaN values.
+    Employee rows for `name` in `offices`. Offices the employee keeps keep their EmployeeID,
+    added offices reuse freed IDs before taking new ones, and the ID logs reference stays.
     """
-    data = {}
-    offices_changed = False
-    employees_changed = False
-    agencies_changed = False
-    contacts_changed = False
-    logs_changed = False
-    production_changed = False
-    tasks_changed = False
+    current = employees[employees['Name'] == name]
+    ids_by_office = dict(zip(current['Office'], current['EmployeeID']))
+    kept_ids = {ids_by_office[off] for off in offices if off in ids_by_office}
+    free_ids = sorted(set(current['EmployeeID']) - kept_ids)
+    next_id = get_new_id(employees, 'EmployeeID')
+    rows = []
+    for off in offices:
+        if off in ids_by_office:
+            emp_id = ids_by_office[off]
+        elif free_ids:
+            emp_id = free_ids.pop(0)
+        else:
+            emp_id, next_id = next_id, next_id + 1
+        rows.append({'EmployeeID': emp_id, 'Name': name, 'Office': off})
+    logged_id = employee_ids(current).get(name)
+    if rows and logged_id is not None and logged_id not in {row['EmployeeID'] for row in rows}:
+        rows[0]['EmployeeID'] = logged_id
+    return pd.DataFrame(rows)
+
+def resolve_log_ids(logs, tables):
+    """
+    Fill in log references that are not set (0) from the logged names: agencies by name
+    (within the logging employee's offices when several agencies share it), contacts by name
+    within that agency (or by name alone if unique), employees by name. Rows whose names
+    match nothing, or still more than one record, keep 0 and are shown under their logged names.
+    """
+    unresolved = (logs[list(LOG_REFERENCES)] == 0).any(axis=1)
+    if not unresolved.any():
+        return logs
+    logs = logs.copy()
+    rows = logs[unresolved]
+    agencies = tables['agencies']
+    candidates = agencies.groupby('AgencyName')[['AgencyID', 'Office']].apply(lambda g: list(g.itertuples(index=False)))
+    offices = tables['employees'].groupby('Name')['Office'].agg(set)
+    resolved = {}
+    for pair in set(zip(rows['AgencyName'].astype(object), rows['EmployeeName'].astype(object))):
+        matches = candidates.get(pair[0], [])
+        if len(matches) > 1:
+            matches = [m for m in matches if m.Office in offices.get(pair[1], ())]
+        resolved[pair] = matches[0].AgencyID if len(matches) == 1 else 0
+    agency_ids = rows['AgencyID'].mask(
+        rows['AgencyID'] == 0,
+        pd.Series(list(zip(rows['AgencyName'].astype(object), rows['EmployeeName'].astype(object))), index=rows.index).map(resolved),
+    ).fillna(0)
+    contacts = tables['contacts']
+    by_agency = dict(zip(zip(contacts['AgencyID'], contacts['Name']), contacts['ContactID']))
+    unique_names = contacts[~contacts['Name'].duplicated(keep=False)]
+    by_name = dict(zip(unique_names['Name'], unique_names['ContactID']))
+    contact_ids = [
+        contact_id or by_agency.get((agency_id, name), by_name.get(name, 0))
+        for contact_id, agency_id, name in zip(rows['ContactID'], agency_ids, rows['ContactName'])
+    ]
+    emp_ids = rows['EmployeeID'].mask(
+        rows['EmployeeID'] == 0, rows['EmployeeName'].astype(object).map(employee_ids(tables['employees']))
+    ).fillna(0)
+    logs.loc[unresolved, 'AgencyID'] = agency_ids.to_numpy(dtype=np.int32)
+    logs.loc[unresolved, 'ContactID'] = np.asarray(contact_ids, dtype=np.int32)
+    logs.loc[unresolved, 'EmployeeID'] = emp_ids.to_numpy(dtype=np.int32)
+    return logs
+
+def with_current_names(logs, tables):
+    """Log rows with the name columns showing the current name of each referenced record."""
+    logs = logs.copy()
+    for id_col, (name_col, key, table_name_col) in LOG_REFERENCES.items():
+        table = tables[key]
+        names = pd.Series(table[table_name_col].to_numpy(), index=table[id_col].to_numpy())
+        names = names[~names.index.duplicated()]
+        logs[name_col] = logs[id_col].map(names).fillna(logs[name_col].astype(object))
+    return logs
 
-    # 1. OFFICES (List)
-    if os.path.exists(FILES['offices']):
-        office_df = pd.read_csv(FILES['offices'])
-        data['offices'] = office_df['OfficeName'].tolist() if 'OfficeName' in office_df.columns else DEFAULT_OFFICES
+def save_to_csv(key):
+    """
+    Commits the session's copy of a table to the shared store (merged with any concurrent
+    edits from other sessions) and queues it for writing.
+    """
+    store = get_data_store()
+    backend = get_storage_backend()
+    synced = st.session_state.setdefault('synced_tables', {})
+    base, base_version = synced.get(key, (None, -1))
+    with store.lock:
+        table, version, conflicts = store.commit(key, st.session_state[key], base, base_version)
+        log_index = store.log_index
+    st.session_state[key] = table
+    if key == 'logs':
+        st.session_state['log_index'] = log_index
+    synced[key] = (table, version)
+    if conflicts:
+        st.session_state.setdefault('save_conflicts', []).extend(conflicts)
+    if key == 'logs':
+        # The session only holds the eagerly loaded months; older partitions are left alone
+        store.writer.save(key, lambda: backend.save_logs(table, store.log_since))
+    elif key == 'production':
+        store.queue_production_write()
     else:
-        data['offices'] = DEFAULT_OFFICES
-        offices_changed = True
+        store.writer.save(key, lambda: backend.save(key, table))
 
-    # 2. EMPLOYEES
-    if os.path.exists(FILES['employees']):
-        data['employees'] = pd.read_csv(FILES['employees'])
-    else:
-        # Create 5 example employees per office: Employee 1, Employee 2, ...
-        rows = []
-        emp_id = 1
-        for office in data['offices']:
-            for i in range(1, 6):
-                rows.append({
-                    'EmployeeID': emp_id,
-                    'Name': f"Employee {i}",
-                    'Office': office
-                })
-                emp_id += 1
-        data['employees'] = pd.DataFrame(rows, columns=['EmployeeID', 'Name', 'Office'])
-        employees_changed = True
-    if employees_changed:
-        data['employees'].to_csv(FILES['employees'], index=False)
+def codes_dtype(n_categories):
+    """Integer dtype pandas uses for the codes of a categorical with this many categories."""
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
 
-    default_underwriter = data['employees']['Name'].iloc[0] if not data['employees'].empty else ""
+class AppendableFrame:
+    """
+    Column arrays with spare capacity behind a DataFrame. Appending writes the new rows
+    into free slots (capacity doubles when full), and frame() is a zero-copy view of the
+    filled rows, so adding a batch never copies the existing table. Categorical columns
+    keep their codes in the array; new values are added as categories.
+    """
 
-    # 3. AGENCIES
-    if os.path.exists(FILES['agencies']):
-        data['agencies'] = pd.read_csv(FILES['agencies'])
-
-        # Ensure columns exist
-        required_cols = ['WebAddress', 'AgencyCode', 'Notes', 'PrimaryUnderwriter']
-        for col in required_cols:
-            if col not in data['agencies'].columns:
-                if col == 'PrimaryUnderwriter':
-                    data['agencies'][col] = default_underwriter
-                    agencies_changed = True
-                else:
-                    data['agencies'][col] = ""
-                    agencies_changed = True
-        # Notes: no NaN
-        if data['agencies']['Notes'].isna().any():
-            data['agencies']['Notes'] = data['agencies']['Notes'].fillna("")
-            agencies_changed = True
+    def __init__(self, df):
+        self.columns = list(df.columns)
+        self.length = len(df)
+        capacity = max(64, 2 * self.length)
+        self.arrays = {}
+        self.categories = {}
+        for col in self.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                self.categories[col] = df[col].cat.categories
+                values = df[col].cat.codes.to_numpy(dtype=codes_dtype(len(self.categories[col])))
+            elif pd.api.types.is_datetime64_any_dtype(df[col]):
+                values = df[col].to_numpy(dtype='datetime64[ns]')
+            elif pd.api.types.is_numeric_dtype(df[col]):
+                values = df[col].to_numpy()
+            else:
+                values = df[col].to_numpy(dtype=object)
+            arr = np.empty(capacity, dtype=values.dtype)
+            arr[:self.length] = values
+            self.arrays[col] = arr
+        self.current = self.frame()
+
+    def _grow(self, needed):
+        capacity = max(needed, 2 * len(next(iter(self.arrays.values()))))
+        for col, arr in self.arrays.items():
+            grown = np.empty(capacity, dtype=arr.dtype)
+            grown[:self.length] = arr[:self.length]
+            self.arrays[col] = grown
+
+    def _codes(self, col, values):
+        """Category codes for values, adding unseen values as categories (widening the codes if needed)."""
+        values = pd.Index(values, dtype=object)
+        categories = self.categories[col]
+        unseen = values.dropna().unique().difference(categories)
+        if len(unseen):
+            categories = self.categories[col] = categories.append(unseen)
+            dtype = codes_dtype(len(categories))
+            if self.arrays[col].dtype != dtype:
+                self.arrays[col] = self.arrays[col].astype(dtype)
+        return categories.get_indexer(values)
+
+    def extend(self, df):
+        needed = self.length + len(df)
+        if self.arrays and needed > len(next(iter(self.arrays.values()))):
+            self._grow(needed)
+        for col in self.columns:
+            values = df[col] if col in df.columns else pd.Series([None] * len(df))
+            if col in self.categories:
+                values = self._codes(col, values)
+            elif self.arrays[col].dtype.kind == 'M':
+                values = pd.to_datetime(values, errors='coerce').to_numpy(dtype='datetime64[ns]')
+            elif self.arrays[col].dtype.kind in 'iuf':
+                values = pd.to_numeric(values, errors='coerce').fillna(0).to_numpy(dtype=self.arrays[col].dtype)
+            else:
+                values = values.to_numpy(dtype=object)
+            self.arrays[col][self.length:needed] = values
+        self.length = needed
+        self.current = self.frame()
+        return self.current
+
+    def _column(self, col):
+        arr = self.arrays[col][:self.length]
+        if col in self.categories:
+            dtype = pd.CategoricalDtype(self.categories[col])
+            return pd.Series(pd.Categorical.from_codes(arr, dtype=dtype, validate=False), copy=False)
+        return pd.Series(arr, dtype=arr.dtype, copy=False)
+
+    def frame(self):
+        return pd.DataFrame({col: self._column(col) for col in self.columns}, copy=False)
+
+def append_logs(new_rows):
+    """
+    Record new activity rows: only the new rows are written (to the append-only journal),
+    and the in-memory log grows in place instead of being concatenated and rewritten.
+    """
+    new_log_df = pd.DataFrame(new_rows)
+    store = get_data_store()
+    with store.lock:
+        logs, version = store.append_logs(new_log_df)
+        log_index = store.log_index
+    st.session_state['logs'] = logs
+    st.session_state['log_index'] = log_index
+    st.session_state.setdefault('synced_tables', {})['logs'] = (logs, version)
+    store.writer.append('logs', new_log_df)
+
+def load_offices(backend, data):
+    """Office codes as a list."""
+    if backend.exists('offices'):
+        office_df = backend.read('offices')
+        return office_df['OfficeName'].tolist() if 'OfficeName' in office_df.columns else DEFAULT_OFFICES
+    backend.write('offices', DEFAULT_OFFICES)
+    return DEFAULT_OFFICES
+
+def missing_columns(key, df):
+    """Schema columns the stored table does not have yet (added by apply_schema, then written back)."""
+    return [col for col in TABLE_SCHEMAS[key] if col not in df.columns]
+
+def load_employees(backend, data):
+    if backend.exists('employees'):
+        return apply_schema('employees', backend.read('employees'))
+    # Create 5 example employees per office: Employee 1, Employee 2, ...
+    rows = []
+    emp_id = 1
+    for office in data['offices']:
+        for i in range(1, 6):
+            rows.append({
+                'EmployeeID': emp_id,
+                'Name': f"Employee {i}",
+                'Office': office
+            })
+            emp_id += 1
+    employees = apply_schema('employees', pd.DataFrame(rows))
+    backend.write('employees', employees)
+    return employees
+
+def load_agencies(backend, data):
+    default_underwriter = data['employees']['Name'].iloc[0] if not data['employees'].empty else ""
+    if backend.exists('agencies'):
+        agencies = backend.read('agencies')
+        missing = missing_columns('agencies', agencies)
+        if 'PrimaryUnderwriter' in missing:
+            agencies['PrimaryUnderwriter'] = default_underwriter
+        agencies = apply_schema('agencies', agencies)
         # Clean WebAddress
-        if 'WebAddress' in data['agencies'].columns:
-            data['agencies']['WebAddress'] = data['agencies']['WebAddress'].fillna("")
-            data['agencies']['WebAddress'] = data['agencies']['WebAddress'].replace(["nan", "NaN", "None"], "")
-
+        agencies['WebAddress'] = agencies['WebAddress'].replace(["nan", "NaN", "None"], "")
+        # Logs and contacts join on AgencyID, so it has to be unique
+        agencies, renumbered = with_unique_ids(agencies, 'AgencyID')
+        agencies_changed = bool(missing) or bool(renumbered)
     else:
-        data['agencies'] = pd.DataFrame(
-            columns=['AgencyID', 'AgencyName', 'Office', 'WebAddress', 'AgencyCode', 'Notes', 'PrimaryUnderwriter']
-        )
+        agencies = apply_schema('agencies', pd.DataFrame())
         agencies_changed = True
 
-    if offices_changed:
-        pd.DataFrame({'OfficeName': data['offices']}).to_csv(FILES['offices'], index=False)
     if agencies_changed:
-        data['agencies'].to_csv(FILES['agencies'], index=False) 
-
-    # 4. CONTACTS
-    if os.path.exists(FILES['contacts']):
-        data['contacts'] = pd.read_csv(FILES['contacts'])
-        if 'Notes' not in data['contacts'].columns:
-            data['contacts']['Notes'] = "" 
-            contacts_changed = True
-        if 'Preferences' not in data['contacts'].columns:
-            data['contacts']['Preferences'] = ""
-            contacts_changed = True
-        if 'LinkedIn' not in data['contacts'].columns:
-            data['contacts']['LinkedIn'] = ""
-            contacts_changed = True
-        if data['contacts']['Notes'].isna().any():
-            data['contacts']['Notes'] = data['contacts']['Notes'].fillna("") 
-            contacts_changed = True
-        # Ensure Phone column exists
-        if 'Phone' not in data['contacts'].columns:
-            data['contacts']['Phone'] = ""
-            contacts_changed = True
-        # Normalize missing values
-        for col in ['Notes', 'Email', 'Phone', 'Preferences', 'LinkedIn']:
-            if col in data['contacts'].columns and data['contacts'][col].isna().any():
-                data['contacts'][col] = data['contacts'][col].fillna("")
-                contacts_changed = True
+        backend.write('agencies', agencies)
+    return agencies
+
+def load_contacts(backend, data):
+    if backend.exists('contacts'):
+        contacts = backend.read('contacts')
+        contacts_changed = bool(missing_columns('contacts', contacts))
     else:
-        data['contacts'] = pd.DataFrame(
-            columns=['ContactID', 'AgencyID', 'Name', 'Role', 'Email', 'Phone', 'Notes', 'Preferences', 'LinkedIn']
-        )
+        contacts = pd.DataFrame()
         contacts_changed = True
+    contacts, renumbered = with_unique_ids(apply_schema('contacts', contacts), 'ContactID')
+    contacts_changed = contacts_changed or bool(renumbered)
     if contacts_changed:
-        data['contacts'].to_csv(FILES['contacts'], index=False)
+        backend.write('contacts', contacts)
+    return contacts
 
-    # 5. LOGS
-    if os.path.exists(FILES['logs']):
-        data['logs'] = pd.read_csv(FILES['logs'])
+def load_logs(backend, data):
+    logs_changed = False
+    since = hot_log_start()
+    if backend.exists('logs'):
+        # Fold any journaled activity into the base file before reading it
+        backend.compact('logs')
+        # Older months stay on disk until a view asks for them (SharedDataStore.cold_logs)
+        logs = backend.read_logs(since=since)
+        if set(missing_columns('logs', logs)) & set(LOG_REFERENCES):
+            # Written before logs carried IDs: resolve the whole history once and store it
+            history = apply_schema('logs', backend.read_logs()).dropna(subset=['Date'])
+            history = resolve_log_ids(history, data)
+            backend.write('logs', history)
+            logs = history[log_date_mask(history, since, None)]
     else:
-        data['logs'] = pd.DataFrame(columns=['Date', 'EmployeeName', 'AgencyName', 'ContactName', 'Type', 'Notes'])
+        logs = pd.DataFrame()
         logs_changed = True
 
-    if not data['logs'].empty and 'Date' in data['logs'].columns:
-        data['logs']['Date'] = pd.to_datetime(data['logs']['Date'], errors='coerce')
-        before_len = len(data['logs'])
-        data['logs'].dropna(subset=['Date'], inplace=True)
-        if len(data['logs']) != before_len:
-            logs_changed = True
+    logs = resolve_log_ids(apply_schema('logs', logs), data)
+    before_len = len(logs)
+    logs = logs.dropna(subset=['Date'])
+    if len(logs) != before_len:
+        logs_changed = True
 
     if logs_changed:
-        data['logs'].to_csv(FILES['logs'], index=False)
-
-    # 6. PRODUCTION
-    if os.path.exists(FILES['production']):
-        prod_df = pd.read_csv(FILES['production'])
-        needed_cols = ['AgencyCode', 'AgencyName', 'Office', 'Month', 'ActiveFlag', 'AllYTDWP', 'AllYTDNB', 'PYTDWP', 'PYTDNB', 'PYTotalNB']
-        for c in needed_cols:
-            if c not in prod_df.columns:
-                prod_df[c] = "" if c in ['AgencyCode', 'AgencyName', 'Office', 'Month', 'ActiveFlag'] else 0
-                production_changed = True
-        prod_df['AllYTDWP'] = pd.to_numeric(prod_df['AllYTDWP'], errors='coerce').fillna(0.0)
-        prod_df['AllYTDNB'] = pd.to_numeric(prod_df['AllYTDNB'], errors='coerce').fillna(0).astype(int)
-        prod_df['PYTDWP'] = pd.to_numeric(prod_df['PYTDWP'], errors='coerce').fillna(0.0)
-        prod_df['PYTDNB'] = pd.to_numeric(prod_df['PYTDNB'], errors='coerce').fillna(0).astype(int)
-        prod_df['PYTotalNB'] = pd.to_numeric(prod_df['PYTotalNB'], errors='coerce').fillna(0).astype(int)
-        data['production'] = prod_df[needed_cols]
+        backend.save_logs(logs, since)
+    return logs
+
+def load_production(backend, data):
+    if backend.exists('production'):
+        prod_df = backend.read('production')
+        production_changed = bool(missing_columns('production', prod_df))
     else:
-        data['production'] = pd.DataFrame(
-            columns=['AgencyCode', 'AgencyName', 'Office', 'Month', 'ActiveFlag', 'AllYTDWP', 'AllYTDNB', 'PYTDWP', 'PYTDNB', 'PYTotalNB']
-        )
+        prod_df = pd.DataFrame()
         production_changed = True
+    production = apply_schema('production', prod_df)[PRODUCTION_COLUMNS + DERIVED_COLUMNS['production']]
 
     if production_changed:
-        data['production'].to_csv(FILES['production'], index=False)
-
-    # 7. TASKS (follow-ups / reminders)
-    if os.path.exists(FILES['tasks']):
-        data['tasks'] = pd.read_csv(FILES['tasks'])
-        needed = ['TaskID', 'AgencyID', 'Title', 'DueDate', 'Status', 'Owner', 'Notes']
-        for c in needed:
-            if c not in data['tasks'].columns:
-                data['tasks'][c] = "" if c not in ['TaskID', 'AgencyID'] else 0
-                tasks_changed = True
-        if 'DueDate' in data['tasks'].columns:
-            # normalize date strings; keep as string for display/input
-            if data['tasks']['DueDate'].isna().any():
-                data['tasks']['DueDate'] = data['tasks']['DueDate'].fillna("")
-                tasks_changed = True
-        if data['tasks'].isna().any().any():
-            data['tasks'] = data['tasks'].fillna("")
-            tasks_changed = True
+        backend.write('production', production)
+    return production
+
+def load_tasks(backend, data):
+    """Follow-ups / reminders."""
+    if backend.exists('tasks'):
+        tasks = backend.read('tasks')
+        tasks_changed = bool(missing_columns('tasks', tasks))
     else:
-        data['tasks'] = pd.DataFrame(
-            columns=['TaskID', 'AgencyID', 'Title', 'DueDate', 'Status', 'Owner', 'Notes']
-        )
+        tasks = pd.DataFrame()
         tasks_changed = True
-
+    # DueDate stays a string for display/input
+    tasks = apply_schema('tasks', tasks)
     if tasks_changed:
-        data['tasks'].to_csv(FILES['tasks'], index=False)
+        backend.write('tasks', tasks)
+    return tasks
+
+# Loaders in dependency order; each gets the tables loaded before it
+TABLE_LOADERS = {
+    'offices': load_offices,
+    'employees': load_employees,
+    'agencies': load_agencies,
+    'contacts': load_contacts,
+    'logs': load_logs,
+    'production': load_production,
+    'tasks': load_tasks,
+}
+
+def load_table(key, data):
+    """Load and normalize a single table; `data` supplies the tables it depends on."""
+    return TABLE_LOADERS[key](get_storage_backend(), data)
 
+def load_data():
+    """
+    Loads data from the storage backend, ensuring all required columns exist and handling NaN values.
+    """
+    data = {}
+    for key in TABLE_LOADERS:
+        data[key] = load_table(key, data)
     return data
 
 # --- PRODUCTION PARSER ---
-def parse_production_excel(uploaded_file, office, month_str):
+def parse_production_excel(uploaded_file, office, month_str, on_error=st.error):
     """
     Parse a monthly production Excel:
     - Sheet: first sheet
     - Real header row contains 'Code' in first column.
+    Problems are reported through on_error (st.error by default).
     """
     try:
-        raw = pd.read_excel(uploaded_file, sheet_name=0, header=None)
+        prod = read_production_sheet(uploaded_file)
     except Exception as e:
-        st.error(f"Error reading Excel file: {e}")
+        on_error(f"Error reading Excel file: {e}")
         return pd.DataFrame()
+    return production_from_sheet(prod, office, month_str, on_error)
 
-    first_col = raw.columns[0]
-    header_idx_list = raw.index[raw[first_col] == 'Code'].tolist()
-    if not header_idx_list:
-        st.error("Could not find a 'Code' header in the uploaded file.")
+def production_from_sheet(prod, office, month_str, on_error=st.error):
+    """Production rows for office and month from read_production_sheet's rows (None: no header found)."""
+    if prod is None:
+        on_error("Could not find a 'Code' header in the uploaded file.")
         return pd.DataFrame()
 
-    header_idx = header_idx_list[0]
-
-    prod = raw.iloc[header_idx:].copy()
-    prod.columns = prod.iloc[0]
-    prod = prod.iloc[1:]
-
-    # Normalize column names (strip spaces and make consistent)
-    prod.columns = [str(c).strip() for c in prod.columns]
-
     prod = prod[prod['Code'].notna() & prod['Agency'].notna()]
 
     # Standardize key columns
@@ -479,11 +1502,1454 @@ def parse_production_excel(uploaded_file, office, month_str):
 
     return prod
 
+# Parsed uploads, keyed by a hash of the file bytes with the office and month (see parse_production_cached)
+IMPORT_CACHE_DIR = os.environ.get("CRM_IMPORT_CACHE_DIR", "crm_import_cache")
+IMPORT_CACHE_ENTRIES = 64  # most recently used parses kept
+
+def upload_bytes(uploaded_file):
+    """The bytes of an uploaded workbook (an upload or in-memory file, a path, or the bytes themselves)."""
+    if isinstance(uploaded_file, bytes):
+        return uploaded_file
+    if hasattr(uploaded_file, 'getvalue'):
+        return uploaded_file.getvalue()
+    with open(uploaded_file, 'rb') as f:
+        return f.read()
+
+def upload_digest(uploaded_file, office, month_str):
+    """SHA-256 of an uploaded workbook's bytes together with the office and month it is imported for."""
+    digest = hashlib.sha256(f"{office}\0{month_str}\0".encode())
+    digest.update(upload_bytes(uploaded_file))
+    return digest.hexdigest()
+
+def import_cache_path(uploaded_file, office, month_str):
+    return os.path.join(IMPORT_CACHE_DIR, upload_digest(uploaded_file, office, month_str) + ".parquet")
+
+def read_import_cache(path):
+    """The parsed rows cached at path, or None when there are none (or the entry is unreadable)."""
+    if not os.path.exists(path):
+        return None
+    try:
+        prod = pd.read_parquet(path)
+        os.utime(path)  # recently used: kept longest
+        return prod
+    except Exception:
+        return None  # parse again and replace it
+
+def write_import_cache(path, prod):
+    """Cache parsed rows at path, evicting the least recently used entries past IMPORT_CACHE_ENTRIES."""
+    if not prod.empty:
+        try:
+            os.makedirs(IMPORT_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            prod.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+            entries = sorted(
+                (entry for entry in os.scandir(IMPORT_CACHE_DIR) if entry.name.endswith(".parquet")),
+                key=lambda entry: entry.stat().st_mtime,
+            )
+            for entry in entries[:-IMPORT_CACHE_ENTRIES]:
+                os.remove(entry.path)
+        except OSError:
+            pass  # the cache is only a shortcut
+
+def parse_production_cached(uploaded_file, office, month_str, on_error=st.error):
+    """
+    parse_production_excel through a small on-disk cache of parsed results, so uploading the
+    same workbook again for the same office and month skips parsing. Returns (rows, cache hit).
+    """
+    path = import_cache_path(uploaded_file, office, month_str)
+    prod = read_import_cache(path)
+    if prod is not None:
+        return prod, True
+    prod = parse_production_excel(uploaded_file, office, month_str, on_error=on_error)
+    write_import_cache(path, prod)
+    return prod, False
+
+def production_period_matches(prod, office, month_str, production):
+    """Whether the production table's rows for office and month are exactly prod's rows (in any order)."""
+    current = production[(production['Office'] == office) & (production['Month'] == month_str)]
+    if len(current) != len(prod):
+        return False
+    def canonical(df):
+        rows = apply_schema('production', df)[PRODUCTION_COLUMNS].astype(str)
+        return rows.sort_values(PRODUCTION_COLUMNS).reset_index(drop=True)
+    return canonical(current).equals(canonical(prod))
+
+# Month names recognized in import file names ("Nov 2025", "2025 November")
+MONTH_ABBREVIATIONS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+IMPORT_WORKERS = int(os.environ.get("CRM_IMPORT_WORKERS", "4"))  # workbooks parsed at once by a batch import
+
+def infer_import_target(filename, offices):
+    """
+    (office, month) of a production workbook from its file name or zip path, e.g.
+    "SDO/2025-11.xlsx", "PHX_202511.xlsx" or "Nov 2025 LAF.xls"; None for a part not found.
+    """
+    stem = os.path.splitext(filename)[0]
+    words = [w.upper() for w in re.split(r"[^A-Za-z0-9]+", stem)]
+    by_code = {str(o).upper(): o for o in offices}
+    office = next((by_code[w] for w in reversed(words) if w in by_code), None)
+    month = None
+    numeric = re.search(r"(?<!\d)(20\d{2})[-_. ]?(0[1-9]|1[0-2])(?!\d)", stem)
+    if numeric:
+        month = f"{numeric.group(1)}-{numeric.group(2)}"
+    else:
+        names = "|".join(MONTH_ABBREVIATIONS)
+        named = re.search(rf"(?i)(?<![a-z])({names})[a-z]*[-_. ]*(20\d{{2}})(?!\d)", stem) or re.search(
+            rf"(?i)(?<!\d)(20\d{{2}})[-_. ]*({names})", stem
+        )
+        if named:
+            year, name = sorted(named.groups(), key=lambda part: not part.isdigit())
+            month = f"{year}-{MONTH_ABBREVIATIONS.index(name[:3].lower()) + 1:02d}"
+    return office, month
+
+def expand_import_files(uploaded_files):
+    """(name, file) for every uploaded workbook, with the workbooks inside .zip uploads unpacked."""
+    for uploaded in uploaded_files:
+        if not uploaded.name.lower().endswith('.zip'):
+            yield uploaded.name, uploaded
+            continue
+        with zipfile.ZipFile(uploaded) as archive:
+            for member in archive.infolist():
+                base = os.path.basename(member.filename)
+                if member.is_dir() or base.startswith(('~$', '.')) or not base.lower().endswith(('.xlsx', '.xls')):
+                    continue
+                data = io.BytesIO(archive.read(member))
+                data.name = member.filename
+                yield member.filename, data
+
+def parse_production_batch(files, offices, production, default_office=None, default_month=None):
+    """
+    Parse many production workbooks at once, each for the office and month in its name
+    (default_office / default_month where the name has none); a workbook whose rows the
+    production table already holds is not returned again. Returns the parsed frames and
+    a report with one row per file: File, Office, Month, Rows, Seconds and Status.
+    Workbooks not in the parse cache are read in a process pool of up to IMPORT_WORKERS, one
+    per CPU (openpyxl parses in pure Python, so threads would take turns); a second workbook
+    for the same office and month is skipped.
+    """
+    jobs, report, targets = [], [], {}
+    for name, data in files:
+        office, month = infer_import_target(name, offices)
+        office, month = office or default_office, month or default_month
+        if not office or not month:
+            status = "Skipped: no office or month in the file name"
+        elif (office, month) in targets:
+            status = f"Skipped: {office} {month} is already imported from {targets[(office, month)]}"
+        else:
+            targets[(office, month)] = name
+            jobs.append((name, upload_bytes(data), office, month))
+            continue
+        report.append({'File': name, 'Office': office, 'Month': month, 'Rows': 0, 'Seconds': 0.0, 'Status': status})
+
+    results = []
+    for name, data, office, month in jobs:
+        started = time.perf_counter()
+        path = import_cache_path(data, office, month)
+        prod = read_import_cache(path)
+        results.append({
+            'path': path, 'prod': prod, 'cached': prod is not None,
+            'seconds': time.perf_counter() - started, 'errors': [],
+        })
+    misses = [i for i, result in enumerate(results) if not result['cached']]
+    workers = min(IMPORT_WORKERS, len(misses), os.cpu_count() or 1)
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) if workers > 1 else None
+    try:
+        sheets = [pool.submit(read_production_sheet_bytes, *jobs[i][:2]) if pool else None for i in misses]
+        for i, sheet in zip(misses, sheets):
+            name, data, office, month = jobs[i]
+            result = results[i]
+            try:
+                rows, seconds = sheet.result() if sheet else read_production_sheet_bytes(name, data)
+            except Exception as e:
+                result['errors'].append(f"Error reading Excel file: {e}")
+                result['prod'] = pd.DataFrame()
+                continue
+            result['seconds'] += seconds
+            result['prod'] = production_from_sheet(rows, office, month, on_error=result['errors'].append)
+            write_import_cache(result['path'], result['prod'])
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
+    frames = []
+    for (name, _, office, month), result in zip(jobs, results):
+        prod, errors = result['prod'], result['errors']
+        if errors or prod.empty:
+            status = "; ".join(errors) or "No rows found"
+        elif result['cached'] and production_period_matches(prod, office, month, production):
+            status = "Already imported (unchanged)"
+        else:
+            frames.append(prod)
+            status = "Imported (cached parse)" if result['cached'] else "Imported"
+        report.append({
+            'File': name, 'Office': office, 'Month': month,
+            'Rows': len(prod), 'Seconds': round(result['seconds'], 2), 'Status': status,
+        })
+    return frames, pd.DataFrame(report, columns=['File', 'Office', 'Month', 'Rows', 'Seconds', 'Status'])
+
+# --- AGENCY MATCHING ---
+MATCH_MIN_SCORE = 0.6  # weakest match proposed for an imported agency
+MATCH_ACCEPT_SCORE = 0.85  # proposals at or above this are pre-selected for acceptance
+MATCH_BLOCK_GRAMS = 8  # rarest trigrams of each imported name used to find candidates
+MATCH_CANDIDATES = 5  # candidates per imported name scored in full
+
+def name_trigrams(names):
+    """
+    Character trigrams of a Series of names, lowercased with punctuation folded to spaces:
+    (positions, trigrams) arrays, each name's distinct trigrams together in position order.
+    """
+    normalized = names.astype(str).str.lower().str.replace(r"[^a-z0-9]+", " ", regex=True).str.strip()
+    grams = pd.Series([list({padded[i:i + 3] for i in range(len(padded) - 2)}) for padded in " " + normalized])
+    grams = grams.explode().dropna()
+    return grams.index.to_numpy(), grams.to_numpy(dtype=object)
+
+def concat_ranges(starts, counts):
+    """np.concatenate([np.arange(s, s + c) for s, c in zip(starts, counts)]) without the loop."""
+    ends = np.cumsum(counts)
+    return np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
+
+def rank_in_groups(groups):
+    """Position of each element within its run of a sorted group array (0 for the first)."""
+    return np.arange(len(groups)) - np.searchsorted(groups, groups)
+
+def match_agencies(imported, agencies):
+    """
+    Propose an existing agency for each imported (AgencyCode, AgencyName) row in one pass.
+    Candidates share one of the row's rarest name trigrams (blocking); each is scored by the
+    mean of the trigram Dice coefficient and containment, so truncated sheet names
+    ("ALLIANT INSURAN") still score high. Every agency is proposed for at most one row,
+    best scores first. Returns the rows with MatchID, MatchName, MatchCode and Score;
+    MatchID is 0 where no agency reaches MATCH_MIN_SCORE.
+    """
+    result = imported[['AgencyCode', 'AgencyName']].reset_index(drop=True)
+    result = result.assign(MatchID=0, MatchName="", MatchCode="", Score=0.0)
+    agencies = agencies.reset_index(drop=True)
+    row_of, row_gram = name_trigrams(result['AgencyName'])
+    agency_of, agency_gram = name_trigrams(agencies['AgencyName'])
+    if not len(row_gram) or not len(agency_gram):
+        return result
+    codes, vocabulary = pd.factorize(np.concatenate([row_gram, agency_gram]))
+    row_gram, agency_gram = codes[:len(row_gram)], codes[len(row_gram):]
+    n_grams, n_agencies = len(vocabulary), len(agencies)
+    frequency = np.bincount(agency_gram, minlength=n_grams)
+
+    # Blocking: each row's MATCH_BLOCK_GRAMS rarest trigrams found in any agency name
+    shared = frequency[row_gram] > 0
+    order = np.lexsort((frequency[row_gram[shared]], row_of[shared]))
+    block_row, block_gram = row_of[shared][order], row_gram[shared][order]
+    block = rank_in_groups(block_row) < MATCH_BLOCK_GRAMS
+    block_row, block_gram = block_row[block], block_gram[block]
+    by_gram = np.argsort(agency_gram, kind='stable')
+    counts = frequency[block_gram]
+    positions = concat_ranges(np.searchsorted(agency_gram[by_gram], block_gram), counts)
+    pair_keys = np.repeat(block_row.astype(np.int64), counts) * n_agencies + agency_of[by_gram][positions]
+    pair_keys, hits = np.unique(pair_keys, return_counts=True)
+
+    # Candidates: the MATCH_CANDIDATES agencies sharing most blocking trigrams with each row
+    order = np.lexsort((-hits, pair_keys // n_agencies))
+    pair_keys = pair_keys[order]
+    top = rank_in_groups(pair_keys // n_agencies) < MATCH_CANDIDATES
+    cand_row, cand_agency = pair_keys[top] // n_agencies, pair_keys[top] % n_agencies
+
+    # Score: count every trigram a candidate shares with its row
+    row_sizes = np.bincount(row_of, minlength=len(result))
+    agency_sizes = np.bincount(agency_of, minlength=n_agencies)
+    expand = row_sizes[cand_row]
+    pair_id = np.repeat(np.arange(len(cand_row)), expand)
+    gram_pos = concat_ranges(np.cumsum(row_sizes)[cand_row] - expand, expand)
+    agency_keys = np.sort(agency_of.astype(np.int64) * n_grams + agency_gram)
+    probe = cand_agency[pair_id] * n_grams + row_gram[gram_pos]
+    found = agency_keys[np.minimum(np.searchsorted(agency_keys, probe), len(agency_keys) - 1)] == probe
+    common = np.bincount(pair_id, weights=found, minlength=len(cand_row))
+    row_size, agency_size = row_sizes[cand_row], agency_sizes[cand_agency]
+    scores = (2 * common / (row_size + agency_size) + common / np.minimum(row_size, agency_size)) / 2
+
+    # One agency per row and one row per agency, best scores first
+    ranked = np.argsort(-scores, kind='stable')
+    ranked = ranked[scores[ranked] >= MATCH_MIN_SCORE]
+    taken_rows, taken_agencies, best = set(), set(), []
+    for position, row, agency in zip(ranked.tolist(), cand_row[ranked].tolist(), cand_agency[ranked].tolist()):
+        if row not in taken_rows and agency not in taken_agencies:
+            taken_rows.add(row)
+            taken_agencies.add(agency)
+            best.append(position)
+    best = np.asarray(best, dtype=int)
+    match = agencies.iloc[cand_agency[best]]
+    rows = cand_row[best]
+    result.loc[rows, 'MatchID'] = match['AgencyID'].to_numpy()
+    result.loc[rows, 'MatchName'] = match['AgencyName'].to_numpy()
+    result.loc[rows, 'MatchCode'] = match['AgencyCode'].to_numpy()
+    result.loc[rows, 'Score'] = scores[best].round(3)
+    return result
+
+def new_agency_rows(rows, office, agencies, employees):
+    """
+    Agencies to create in `office` for imported (AgencyCode, AgencyName) rows whose code the
+    office does not have yet. WebAddress and Notes are copied from an agency holding the same
+    code in another office; the office's first employee is the default underwriter.
+    """
+    rows = rows[['AgencyCode', 'AgencyName']].astype(str).apply(lambda col: col.str.strip())
+    office_codes = agencies.loc[agencies['Office'] == office, 'AgencyCode']
+    rows = rows[rows['AgencyCode'].ne("") & ~rows['AgencyCode'].isin(office_codes)].drop_duplicates('AgencyCode')
+    # pick a default underwriter if available
+    office_emps = employees[employees['Office'] == office]
+    default_uw = office_emps['Name'].iloc[0] if not office_emps.empty else ""
+    same_code = agencies[agencies['AgencyCode'].ne("")].drop_duplicates('AgencyCode')
+    new_ag_df = rows.merge(same_code[['AgencyCode', 'WebAddress', 'Notes']], on='AgencyCode', how='left')
+    return pd.DataFrame({
+        'AgencyID': get_new_id(agencies, 'AgencyID') + np.arange(len(new_ag_df)),
+        'AgencyName': new_ag_df['AgencyName'],
+        'Office': office,
+        'WebAddress': new_ag_df['WebAddress'].fillna(""),
+        'AgencyCode': new_ag_df['AgencyCode'],
+        'Notes': new_ag_df['Notes'].fillna(""),
+        'PrimaryUnderwriter': default_uw,
+    })
+
+def new_agency_proposals(new_prod, office, agencies):
+    """
+    The agencies an office's imported production introduces (codes the office lacks), each
+    with its likely existing agency from match_agencies (MatchID 0 where there is none).
+    """
+    existing_codes = agencies[agencies['Office'] == office]['AgencyCode'].tolist()
+
+    # Deduplicate by AgencyCode within this import batch
+    candidate_agencies = new_prod.copy()
+    candidate_agencies['AgencyCode'] = candidate_agencies['AgencyCode'].astype(str).str.strip()
+    candidate_agencies['AgencyName'] = candidate_agencies['AgencyName'].astype(str).str.strip()
+    candidate_agencies = candidate_agencies.drop_duplicates(subset=['AgencyCode'])
+
+    missing_mask = ~candidate_agencies['AgencyCode'].isin(existing_codes) & \
+                   candidate_agencies['AgencyCode'].ne("")
+    to_add = candidate_agencies[missing_mask]
+
+    # Near-duplicates of this office's agencies: truncated names, missing or changed codes
+    office_agencies = agencies[
+        (agencies['Office'] == office)
+        & ~agencies['AgencyCode'].isin(candidate_agencies['AgencyCode'])
+    ]
+    return match_agencies(to_add, office_agencies)
+
+def with_matched_codes(agencies, accepted):
+    """agencies with each accepted match's existing agency given the imported AgencyCode."""
+    agencies = agencies.copy()
+    codes = agencies['AgencyID'].map(dict(zip(accepted['MatchID'], accepted['AgencyCode'])))
+    agencies['AgencyCode'] = codes.fillna(agencies['AgencyCode'].astype(object))
+    return agencies
+
+def add_imported_agencies(rows, office):
+    """Create agencies in `office` for imported rows (see new_agency_rows) as one append; returns how many were added."""
+    agencies = st.session_state['agencies']
+    new_ag_df = new_agency_rows(rows, office, agencies, st.session_state['employees'])
+    if new_ag_df.empty:
+        return 0
+    st.session_state['agencies'] = pd.concat([agencies, new_ag_df], ignore_index=True)
+    save_to_csv('agencies')
+    return len(new_ag_df)
+
+def replace_production(new_prod):
+    """
+    Upsert imported production: each Office/Month in new_prod gets exactly its rows, and only
+    those periods are rewritten in storage. Returns the inserted/updated/removed row counts.
+    """
+    table, version, counts = get_data_store().upsert_production(new_prod)
+    st.session_state['production'] = table
+    st.session_state.setdefault('synced_tables', {})['production'] = (table, version)
+    return counts
+
+def import_new_agencies(new_prod, office):
+    """
+    Add the agencies an office's imported production introduces. Likely matches with existing
+    agencies are queued for review in the sidebar, the rest are created.
+    Returns (added, queued for review).
+    """
+    proposals = new_agency_proposals(new_prod, office, st.session_state['agencies'])
+    matched = proposals[proposals['MatchID'] != 0]
+    if not matched.empty:
+        reviews = st.session_state.setdefault('agency_match_reviews', {})
+        pending = pd.concat([reviews.get(office), matched], ignore_index=True)
+        reviews[office] = pending.drop_duplicates('AgencyCode', keep='last')
+        st.session_state.pop(f"agency_match_editor_{office}", None)
+    return add_imported_agencies(proposals[proposals['MatchID'] == 0], office), len(matched)
+
+def apply_agency_matches(accepted):
+    """Give each accepted match's existing agency the imported AgencyCode, so later imports match it exactly."""
+    if accepted.empty:
+        return
+    st.session_state['agencies'] = with_matched_codes(st.session_state['agencies'], accepted)
+    save_to_csv('agencies')
+
+# --- SHARED DATA STORE ---
+class WriteBehindQueue(threading.Thread):
+    """
+    Persists table changes off the script thread. Saves of a table queued within
+    `delay` seconds of each other are coalesced into one write of the latest copy, and
+    appended rows are batched into one append. flush() writes everything now; it runs
+    at interpreter exit so queued changes survive a shutdown.
+    """
+
+    def __init__(self, backend, delay):
+        super().__init__(name="crm-write-behind", daemon=True)
+        self.backend = backend
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.flush_lock = threading.RLock()
+        # key -> {'save': callable writing the latest copy or None, 'appends': [frames], 'queued_at': monotonic}
+        self.pending = {}
+        self.errors = {}  # key -> message from the last failed flush
+
+    def _queue(self, key):
+        item = self.pending.get(key)
+        if item is None:
+            item = self.pending[key] = {'save': None, 'appends': [], 'queued_at': time.monotonic()}
+        return item
+
+    def save(self, key, write):
+        """Queue write() as the table's next full save, replacing any save still waiting."""
+        with self.cond:
+            item = self._queue(key)
+            item['save'] = write
+            # The saved copy already contains any rows appended before it
+            item['appends'] = []
+            self.cond.notify()
+        if self.delay <= 0:
+            self.flush([key])
+
+    def append(self, key, df):
+        """Queue rows to append to the table."""
+        with self.cond:
+            self._queue(key)['appends'].append(df)
+            self.cond.notify()
+        if self.delay <= 0:
+            self.flush([key])
+
+    def pending_tables(self):
+        with self.cond:
+            return sorted(self.pending)
+
+    def is_pending(self, key):
+        with self.cond:
+            return key in self.pending
+
+    def flush(self, keys=None):
+        """Write the queued changes for `keys` (default: every table) now."""
+        with self.flush_lock:
+            for key in keys if keys is not None else self.pending_tables():
+                self._flush_key(key)
+
+    def _flush_key(self, key):
+        with self.cond:
+            item = self.pending.pop(key, None)
+        if item is None:
+            return
+        try:
+            if item['save'] is not None:
+                item['save']()
+            if item['appends']:
+                self.backend.append(key, pd.concat(item['appends'], ignore_index=True))
+            self.errors.pop(key, None)
+        except Exception as e:
+            self.errors[key] = str(e)
+            # Put the failed write back ahead of anything queued since, and retry after the delay
+            with self.cond:
+                newer = self.pending.get(key)
+                if newer is None:
+                    item['queued_at'] = time.monotonic()
+                    self.pending[key] = item
+                elif newer['save'] is None:
+                    newer['save'] = item['save']
+                    newer['appends'] = item['appends'] + newer['appends']
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                now = time.monotonic()
+                due = [key for key, item in self.pending.items() if item['queued_at'] + self.delay <= now]
+                if not due:
+                    self.cond.wait(min(item['queued_at'] for item in self.pending.values()) + self.delay - now)
+                    continue
+            self.flush(due)
+
+def merge_table_edit(key, base, mine, current):
+    """
+    Three-way merge of a session's edit (base -> mine) into the shared table (current).
+    Row hashes serve as per-row version stamps: a row the session changed or deleted is
+    replaced only if current still holds it as the session saw it; otherwise the other
+    writer's row is kept and reported as a conflict. Inserted rows whose ID another
+    session has taken meanwhile get the next free ID. Returns (merged, conflicts).
+    """
+    base_df, mine_df, cur_df = (table_frame(key, t).reset_index(drop=True) for t in (base, mine, current))
+    if not (list(base_df.columns) == list(mine_df.columns) == list(cur_df.columns)):
+        # Columns were added or reordered; there is no row-level edit to merge
+        return mine, []
+
+    base_ids = hash_occurrences(row_hashes(to_storage_frame(base_df)))
+    mine_ids = hash_occurrences(row_hashes(to_storage_frame(mine_df)))
+    cur_ids = hash_occurrences(row_hashes(to_storage_frame(cur_df)))
+    removed_mask = ~base_ids.isin(mine_ids)
+    removed = base_df[removed_mask]  # rows this session changed or deleted
+    added = mine_df[~mine_ids.isin(base_ids)]  # rows this session changed or inserted
+    # Where each removed row sits in the current table, if it is still there unchanged
+    cur_label = pd.Series(cur_df.index, index=cur_ids).reindex(base_ids[removed_mask])
+    cur_label.index = removed.index
+
+    keys = TABLE_KEYS.get(key, [])
+
+    def row_keys(df):
+        if not keys or df.empty:
+            return pd.Series("", index=df.index, dtype=object)
+        return to_storage_frame(df[keys]).astype(str).agg("\x1f".join, axis=1)
+
+    def describe(row):
+        if keys:
+            return f"{key}: " + ", ".join(f"{k} {row[k]}" for k in keys)
+        return f"{key}: " + " / ".join(str(v) for v in row.iloc[:3])
+
+    removed_keys, added_keys, cur_keys = row_keys(removed), row_keys(added), set(row_keys(cur_df))
+    # A removed and an added row sharing a unique key are one edited row
+    updates = {}
+    if keys:
+        unique_removed = removed_keys[~removed_keys.duplicated(keep=False)]
+        unique_added = added_keys[~added_keys.duplicated(keep=False)]
+        removed_by_key = dict(zip(unique_removed, unique_removed.index))
+        updates = {label: removed_by_key[k] for label, k in unique_added.items() if k in removed_by_key}
+    updated_removed = set(updates.values())
+
+    conflicts = []
+    replaced = {}  # current label -> added label taking its place (None = deleted)
+    for label, row in removed.iterrows():
+        if pd.notna(cur_label[label]):
+            replaced[int(cur_label[label])] = None
+        elif label in updated_removed or (keys and removed_keys[label] in cur_keys):
+            # Changed (or edited and deleted) by someone else since this session read it
+            conflicts.append(describe(row))
+    for added_label, removed_label in updates.items():
+        if pd.notna(cur_label[removed_label]):
+            replaced[int(cur_label[removed_label])] = added_label
+
+    inserts = added.drop(index=list(updates))
+    if keys and not inserts.empty:
+        taken = row_keys(inserts).isin(cur_keys)
+        id_col = keys[0] if len(keys) == 1 and keys[0].endswith("ID") else None
+        if taken.any() and id_col:
+            ids = pd.concat([cur_df[id_col], inserts[id_col]]).pipe(pd.to_numeric, errors='coerce').dropna()
+            next_id = int(get_new_id(ids.to_frame(id_col), id_col))
+            inserts = inserts.copy()
+            inserts.loc[taken, id_col] = range(next_id, next_id + int(taken.sum()))
+        elif taken.any():
+            conflicts.extend(describe(row) for _, row in inserts[taken].iterrows())
+            inserts = inserts[~taken]
+
+    # Rebuild in current order: edited rows keep their position, inserts go last
+    parts = [
+        cur_df.drop(index=list(replaced)),
+        added.loc[[a for a in replaced.values() if a is not None]].set_axis(
+            [c for c, a in replaced.items() if a is not None]
+        ),
+        inserts.set_axis(range(len(cur_df), len(cur_df) + len(inserts))),
+    ]
+    parts = [p for p in parts if not p.empty]
+    merged = pd.concat(parts).sort_index(kind='stable').reset_index(drop=True) if parts else cur_df.iloc[:0]
+    if key == 'offices' and not isinstance(current, pd.DataFrame):
+        merged = merged['OfficeName'].tolist()
+    return merged, conflicts
+
+def tokenize(text):
+    """Lowercase word tokens of a note (letters and digits)."""
+    return re.findall(r"[a-z0-9]+", str(text).lower())
+
+def parse_search_query(query):
+    """Split a search into terms: ('phrase', tokens) for "quoted text", ('prefix', tok) for tok*, else ('word', tok)."""
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query):
+        if phrase:
+            tokens = tokenize(phrase)
+            if len(tokens) > 1:
+                terms.append(('phrase', tokens))
+            elif tokens:
+                terms.append(('word', tokens[0]))
+        elif word.endswith("*") and tokenize(word):
+            *words, prefix = tokenize(word)
+            terms.extend(('word', tok) for tok in words)
+            terms.append(('prefix', prefix))
+        else:
+            terms.extend(('word', tok) for tok in tokenize(word))
+    return terms
+
+def search_as_typed(query):
+    """
+    A search box query whose last word, while still being typed, also matches longer words
+    ("renew" finds "renewal"); a trailing space, quote or * leaves the query as it is.
+    """
+    if not query or query[-1].isspace() or query.endswith(('*', '"')) or not tokenize(query.split()[-1]):
+        return query
+    return query + "*"
+
+class NotesIndex:
+    """
+    Inverted index over free-text notes: token -> {doc: term frequency}. Documents are row
+    positions (logs) or record IDs (contacts, agencies) and are added as they are inserted.
+    search() matches every term of a query (keywords, "phrases", prefix*) and ranks by tf-idf.
+    """
+
+    def __init__(self, docs=(), texts=()):
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.doc_count = 0
+        self.vocabulary = []  # sorted tokens for prefix lookups, rebuilt when new tokens arrive
+        self.vocabulary_stale = False
+        self.add(docs, texts)
+
+    def add(self, docs, texts):
+        with self.lock:
+            for doc, text in zip(docs, texts):
+                tokens = tokenize(text) if isinstance(text, str) else []
+                if not tokens:
+                    continue
+                self.doc_count += 1
+                for token in tokens:
+                    posting = self.postings.get(token)
+                    if posting is None:
+                        posting = self.postings[token] = {}
+                        self.vocabulary_stale = True
+                    posting[doc] = posting.get(doc, 0) + 1
+
+    def remove(self, docs, texts):
+        """Take documents out of the index; texts must be what they were added with."""
+        with self.lock:
+            for doc, text in zip(docs, texts):
+                tokens = tokenize(text) if isinstance(text, str) else []
+                if not tokens:
+                    continue
+                self.doc_count -= 1
+                for token in set(tokens):
+                    posting = self.postings.get(token)
+                    if posting is None:
+                        continue
+                    posting.pop(doc, None)
+                    if not posting:
+                        del self.postings[token]
+                        self.vocabulary_stale = True
+
+    def _prefix_tokens(self, prefix):
+        if self.vocabulary_stale:
+            self.vocabulary = sorted(self.postings)
+            self.vocabulary_stale = False
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        tokens = []
+        for token in self.vocabulary[start:]:
+            if not token.startswith(prefix):
+                break
+            tokens.append(token)
+        return tokens
+
+    @staticmethod
+    def _restrict(posting, candidates):
+        if candidates is None:
+            return posting
+        if len(candidates) < len(posting):
+            return {doc: posting[doc] for doc in candidates if doc in posting}
+        return {doc: tf for doc, tf in posting.items() if doc in candidates}
+
+    def _term_postings(self, term):
+        kind, value = term
+        if kind == 'word':
+            return [self.postings.get(value, {})]
+        if kind == 'prefix':
+            return [self.postings[token] for token in self._prefix_tokens(value)]
+        return [self.postings.get(token, {}) for token in value]
+
+    def _term_matches(self, term, postings, text_of, candidates):
+        kind, value = term
+        if kind == 'word':
+            return self._restrict(postings[0], candidates)
+        if kind == 'prefix':
+            matches = {}
+            for posting in postings:
+                for doc, tf in self._restrict(posting, candidates).items():
+                    matches[doc] = matches.get(doc, 0) + tf
+            return matches
+        # Phrase: documents holding every token, confirmed against the text
+        found = set(min(postings, key=len))
+        if candidates is not None:
+            found &= candidates
+        for posting in postings:
+            found &= posting.keys()
+        width = len(value)
+        matches = {}
+        for doc in found:
+            tokens = tokenize(text_of(doc))
+            hits = sum(tokens[i:i + width] == value for i in range(len(tokens) - width + 1))
+            if hits:
+                matches[doc] = hits
+        return matches
+
+    def search(self, query, text_of, docs=None, limit=None):
+        """
+        [(doc, score)] for documents matching every term, best first (newer doc on ties).
+        text_of(doc) returns a document's text for phrase checks; docs limits the candidates.
+        Terms are matched rarest first, each only against the documents still in the running.
+        """
+        terms = parse_search_query(query)
+        if not terms:
+            return []
+        with self.lock:
+            planned = []
+            for term in terms:
+                postings = self._term_postings(term)
+                size = sum(len(p) for p in postings) if term[0] == 'prefix' else min(len(p) for p in postings)
+                planned.append((size, term, postings))
+            planned.sort(key=lambda item: item[0])
+            candidates = set(docs) if docs is not None else None
+            scores = {}
+            for size, term, postings in planned:
+                matches = self._term_matches(term, postings, text_of, candidates)
+                idf = np.log(1 + self.doc_count / (1 + size))
+                if candidates is None:
+                    scores = {doc: tf * idf for doc, tf in matches.items()}
+                else:
+                    scores = {doc: scores.get(doc, 0) + tf * idf for doc, tf in matches.items()}
+                candidates = set(matches)
+                if not candidates:
+                    return []
+        key = lambda item: (item[1], item[0])
+        if limit:
+            return heapq.nlargest(limit, scores.items(), key=key)
+        return sorted(scores.items(), key=key, reverse=True)
+
+class LogIndex:
+    """
+    Secondary indexes over the activity log: row positions per AgencyID, ContactID and
+    EmployeeID, positions sorted by date for range lookups, and a NotesIndex over Notes.
+    As in ActivityCube, rows with no EmployeeID (0) are indexed under their logged EmployeeName.
+    Built once per log frame and extended as rows are appended (positions never move in an
+    AppendableFrame), so a lookup is a dict hit or a binary search instead of a table scan.
+    """
+
+    KEYS = {'agency': 'AgencyID', 'contact': 'ContactID', 'employee': 'EmployeeID'}
+
+    def __init__(self, logs):
+        self.length = 0
+        self.positions = {name: {} for name in self.KEYS}
+        self.by_date = (np.empty(0, dtype='datetime64[ns]'), np.empty(0, dtype=np.int64))
+        self.notes = NotesIndex()
+        self.extend(logs)
+
+    def extend(self, rows):
+        """Index rows appended after the ones already indexed."""
+        rows = rows.iloc[self.length:] if len(rows) > self.length else rows.iloc[:0]
+        if rows.empty:
+            return
+        offset = self.length
+        for name, col in self.KEYS.items():
+            index = self.positions[name]
+            for value, found in self._groups(rows[col]):
+                found = found + offset
+                index[value] = np.concatenate([index[value], found]) if value in index else found
+        unresolved = np.flatnonzero(rows['EmployeeID'].to_numpy() == 0)
+        index = self.positions['employee']
+        for value, found in pd.Series(unresolved + offset).groupby(rows['EmployeeName'].to_numpy(dtype=object)[unresolved]):
+            found = found.to_numpy(dtype=np.int64)
+            index[value] = np.concatenate([index[value], found]) if value in index else found
+        dates = rows['Date'].to_numpy(dtype='datetime64[ns]')
+        valid = ~np.isnat(dates)
+        new_values, new_order = dates[valid], np.flatnonzero(valid).astype(np.int64) + offset
+        values, order = self.by_date
+        if len(values) and len(new_values) and new_values.min() < values[-1]:
+            # Backdated rows: merge into the sorted order
+            values, order = np.concatenate([values, new_values]), np.concatenate([order, new_order])
+            sort = np.argsort(values, kind='stable')
+            self.by_date = (values[sort], order[sort])
+        else:
+            sort = np.argsort(new_values, kind='stable')
+            self.by_date = (np.concatenate([values, new_values[sort]]), np.concatenate([order, new_order[sort]]))
+        self.notes.add(range(offset, offset + len(rows)), rows['Notes'])
+        self.length += len(rows)
+
+    @staticmethod
+    def _groups(ids):
+        """(id, positions) per distinct ID; unresolved references (0) are not indexed."""
+        codes, uniques = pd.factorize(ids)
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        for start, end in zip(starts, ends):
+            value = int(uniques[sorted_codes[start]])
+            if value:
+                yield value, order[start:end]
+
+    def _lookup(self, name, values):
+        index = self.positions[name]
+        key = lambda v: v if isinstance(v, str) else int(v)
+        if np.isscalar(values):
+            return index.get(key(values), np.empty(0, dtype=np.int64))
+        found = [index[key(v)] for v in values if key(v) in index]
+        return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+
+    def _date_range(self, since=None, before=None):
+        values, order = self.by_date
+        start = np.searchsorted(values, np.datetime64(pd.Timestamp(since), 'ns')) if since is not None else 0
+        end = np.searchsorted(values, np.datetime64(pd.Timestamp(before), 'ns')) if before is not None else len(values)
+        return np.sort(order[start:end])
+
+    def rows(self, agency=None, contact=None, employee=None, since=None, before=None, notes=None, text_of=None):
+        """
+        Sorted positions of the rows matching every given criterion. agency, contact and
+        employee take an ID or a list of IDs (employee also a logged name, matching the rows
+        that have no EmployeeID); since/before bound the Date (before is
+        exclusive); notes is a search query (see NotesIndex.search, text_of for phrases).
+        """
+        candidates = []
+        if agency is not None:
+            candidates.append(self._lookup('agency', agency))
+        if contact is not None:
+            candidates.append(self._lookup('contact', contact))
+        if employee is not None:
+            candidates.append(self._lookup('employee', employee))
+        if since is not None or before is not None:
+            candidates.append(self._date_range(since, before))
+        if notes is not None:
+            found = [doc for doc, _ in self.notes.search(notes, text_of)]
+            candidates.append(np.sort(np.asarray(found, dtype=np.int64)))
+        if not candidates:
+            return np.arange(self.length)
+        positions = candidates[0]
+        for other in candidates[1:]:
+            positions = np.intersect1d(positions, other, assume_unique=True)
+        return positions
+
+    def select(self, logs, **criteria):
+        """The rows of `logs` (the frame this index was built from) matching criteria."""
+        positions = self.rows(text_of=self._text_of(logs), **criteria)
+        # Rows appended after this session synced its frame are not in it yet
+        return logs.iloc[positions[positions < len(logs)]]
+
+    def search(self, logs, query, limit=None):
+        """Rows of `logs` whose Notes match query, best match first, with a Score column."""
+        ranked = [(doc, score) for doc, score in self.notes.search(query, self._text_of(logs)) if doc < len(logs)]
+        ranked = ranked[:limit] if limit else ranked
+        found = logs.iloc[[doc for doc, _ in ranked]]
+        return found.assign(Score=[score for _, score in ranked])
+
+    @staticmethod
+    def _text_of(logs):
+        notes = logs['Notes']
+        return lambda pos: notes.iat[pos] if pos < len(notes) else ""
+
+class LastContactTable:
+    """
+    Materialized last activity per contact: ContactID -> (date, type, EmployeeID).
+    Built from the log once; every logged row then updates it in O(1).
+    """
+
+    def __init__(self, logs):
+        latest = logs[(logs['ContactID'] != 0) & logs['Date'].notna()].sort_values('Date', kind='stable')
+        latest = latest.drop_duplicates('ContactID', keep='last')
+        self.entries = {
+            int(contact_id): (when, kind, int(employee_id))
+            for contact_id, when, kind, employee_id in zip(
+                latest['ContactID'], latest['Date'], latest['Type'], latest['EmployeeID']
+            )
+        }
+
+    def update(self, rows):
+        """Fold newly logged rows in; only rows newer than the current entry replace it."""
+        dates = pd.to_datetime(rows['Date'], errors='coerce')
+        for contact_id, when, kind, employee_id in zip(rows['ContactID'], dates, rows['Type'], rows['EmployeeID']):
+            if not contact_id or pd.isna(when):
+                continue
+            current = self.entries.get(int(contact_id))
+            if current is None or when >= current[0]:
+                self.entries[int(contact_id)] = (when, kind, int(employee_id))
+
+    def get(self, contact_id):
+        """(date, type, EmployeeID) of the contact's latest activity, or None."""
+        return self.entries.get(int(contact_id))
+
+class ActivityCube:
+    """
+    Activity counts per (day, employee, Type), kept per employee so a windowed total is a
+    sum over at most one bucket per day. Built from the log once; each logged row then adds
+    one count. Offices roll up through the employee table, since logs do not record one and
+    an employee can work in several. Rows whose EmployeeID is unresolved (0) are counted
+    under their logged EmployeeName instead.
+    """
+
+    def __init__(self, logs):
+        self.counts = {}  # EmployeeID or logged name -> {Type: {date: count}}
+        self.add(logs)
+
+    def add(self, rows):
+        days = pd.to_datetime(rows['Date'], errors='coerce').dt.normalize()
+        employees = np.asarray(rows['EmployeeID']).astype(int).astype(object)
+        unresolved = employees == 0
+        employees[unresolved] = np.asarray(rows['EmployeeName'], dtype=object)[unresolved]
+        keys = pd.DataFrame({
+            'Employee': employees,
+            'Type': np.asarray(rows['Type'], dtype=object),
+            'Day': days.to_numpy(),
+        }).dropna()
+        for (employee, kind, day), n in keys.value_counts().items():
+            buckets = self.counts.setdefault(employee, {}).setdefault(kind, {})
+            buckets[day.date()] = buckets.get(day.date(), 0) + int(n)
+
+    def total(self, employee, kind, since):
+        """
+        Activities of one type dated on or after `since` (a date) by one employee: an
+        EmployeeID, or a name for the rows logged under it that have no EmployeeID.
+        """
+        key = employee if isinstance(employee, str) else int(employee)
+        buckets = self.counts.get(key, {}).get(kind, {})
+        # Snapshot the buckets: a logged activity may add one while this sums
+        return sum(n for day, n in tuple(buckets.items()) if day >= since)
+
+def build_latest_production(production, agencies):
+    """
+    Latest production snapshot per agency: one row per AgencyCode from its most recent month,
+    with the prior month's AllYTDWP (PrevAllYTDWP, for trends) and the AgencyID,
+    PrimaryUnderwriter and Office of the agency holding the code (lowest AgencyID first).
+    """
+    prod = production.dropna(subset=['Month_dt']).sort_values('Month_dt', kind='stable')
+    last_two = prod.groupby('AgencyCode', sort=False).tail(2)
+    latest = last_two.drop_duplicates('AgencyCode', keep='last').set_index('AgencyCode')
+    previous = last_two[last_two.duplicated('AgencyCode', keep='last')].set_index('AgencyCode')
+    latest['PrevAllYTDWP'] = previous['AllYTDWP']
+    owners = agencies.sort_values('AgencyID').drop_duplicates('AgencyCode')
+    owners = owners[['AgencyCode', 'AgencyID', 'PrimaryUnderwriter', 'Office']].rename(columns={'Office': 'AgencyOffice'})
+    latest = latest.reset_index().merge(owners, on='AgencyCode', how='left')
+    # Show the agency's office where the code belongs to one, else the importing office
+    latest['Office'] = latest['AgencyOffice'].fillna(latest['Office'].astype(object))
+    return latest.drop(columns=['AgencyOffice'])
+
+# Fields the global search indexes per table: (ID column, name column, other searchable columns)
+ENTITY_SEARCH_FIELDS = {
+    'agencies': ('AgencyID', 'AgencyName', ['AgencyCode']),
+    'contacts': ('ContactID', 'Name', ['Email']),
+    'employees': ('EmployeeID', 'Name', []),
+}
+
+class EntityIndex:
+    """
+    Typeahead index over one table's ENTITY_SEARCH_FIELDS: every word of a record's name,
+    code or email, sorted, so that all words starting with a prefix are one binary search.
+    Matches are row positions in `table`, since IDs are not guaranteed unique.
+    """
+
+    def __init__(self, key, table):
+        id_col, name_col, other_cols = ENTITY_SEARCH_FIELDS[key]
+        if key == 'employees':
+            table = table.drop_duplicates('Name')  # one entry per person, not per office row
+        self.table = table.reset_index(drop=True)
+        self.names = table[name_col].astype(str).str.lower().to_numpy(dtype=object)
+        words = pd.concat([
+            table[col].astype(str).str.lower().str.replace(r"[^a-z0-9]+", " ", regex=True).str.split()
+            .set_axis(range(len(table)))
+            for col in [name_col] + other_cols
+        ]).explode().dropna().sort_values(kind='stable')
+        self.words = words.to_numpy(dtype=object)
+        self.owners = words.index.to_numpy()  # position of the record each word belongs to
+
+    def search(self, query):
+        """
+        (row positions, tiers, name lengths) of records where every word of query starts one
+        of their words; tier 0 when the name itself starts with the query, else 1.
+        """
+        found = None
+        for word in tokenize(query):
+            lo, hi = np.searchsorted(self.words, [word, word + "\uffff"])
+            positions = np.unique(self.owners[lo:hi])
+            found = positions if found is None else np.intersect1d(found, positions, assume_unique=True)
+            if not len(found):
+                break
+        if found is None:
+            found = np.array([], dtype=int)
+        names = self.names[found]
+        text = query.strip().lower()
+        tiers = np.array([0 if name.startswith(text) else 1 for name in names], dtype=int)
+        return found, tiers, np.array([len(name) for name in names], dtype=int)
+
+def production_changes(old, new):
+    """
+    Counts of production rows inserted, updated and removed going from `old` to `new` (rows of
+    the same periods), keyed on (Office, Month, AgencyCode); unchanged rows are not counted.
+    """
+    def keyed(df):
+        rows = df[PRODUCTION_COLUMNS].astype(str)
+        hashes = pd.util.hash_pandas_object(rows, index=False)
+        return dict(zip(zip(rows['Office'], rows['Month'], rows['AgencyCode']), hashes))
+    before, after = keyed(old), keyed(new)
+    return {
+        'inserted': sum(key not in before for key in after),
+        'updated': sum(key in before and before[key] != row for key, row in after.items()),
+        'removed': sum(key not in after for key in before),
+    }
+
+class SharedDataStore:
+    """
+    Tables loaded once per server process and shared read-only by every session.
+    Each write bumps a monotonically increasing data version and records which table
+    changed, so other sessions refresh only those tables on their next rerun.
+    Sessions must not mutate shared frames in place; edit a copy and save_to_csv() it.
+    """
+
+    def __init__(self, data, backend):
+        self.lock = threading.RLock()
+        self.backend = backend
+        self.tables = dict(data)
+        for key, table in self.tables.items():
+            note_issued_ids(backend, key, table)
+        self.version = 0
+        self.table_versions = {key: 0 for key in self.tables}
+        self.log_buffer = AppendableFrame(self.tables['logs'])
+        self.tables['logs'] = self.log_buffer.current
+        self.log_index = LogIndex(self.tables['logs'])
+        self.last_contact = LastContactTable(self.tables['logs'])
+        self.activity = ActivityCube(self.tables['logs'])
+        self.latest_production = build_latest_production(self.tables['production'], self.tables['agencies'])
+        # Log notes are indexed by LogIndex; these cover the agency and contact notes
+        self.notes_indexes = {key: self._index_notes(key) for key in ('agencies', 'contacts')}
+        self.entity_indexes = {}  # global search, built on first use per table (entity_index)
+        # Months before log_since are not in memory; cold_logs() reads them on demand
+        self.log_since = hot_log_start()
+        self.has_cold_logs = backend.has_logs_before(self.log_since)
+        self.cold = None
+        self.writer = WriteBehindQueue(backend, WRITE_DELAY_SECONDS)
+        # Production periods (office, month) changed since the last write; None when the whole table is
+        self.production_dirty = set()
+
+    def _index_notes(self, key):
+        table = self.tables[key]
+        return NotesIndex(table[TABLE_KEYS[key][0]].astype(int), table['Notes'])
+
+    def _update_notes(self, key, old, new):
+        """Re-index only the records whose notes differ between two versions of a table."""
+        id_col = TABLE_KEYS[key][0]
+        if old[id_col].duplicated().any() or new[id_col].duplicated().any():
+            # Documents are record IDs; without unique IDs, start over
+            self.notes_indexes[key] = self._index_notes(key)
+            return
+        old_notes = pd.Series(old['Notes'].to_numpy(dtype=object), index=old[id_col].astype(int).to_numpy()).fillna("")
+        new_notes = pd.Series(new['Notes'].to_numpy(dtype=object), index=new[id_col].astype(int).to_numpy()).fillna("")
+        kept = old_notes.index.intersection(new_notes.index)
+        changed = kept[old_notes[kept].to_numpy() != new_notes[kept].to_numpy()]
+        removed = old_notes.index.difference(new_notes.index).union(changed)
+        added = new_notes.index.difference(old_notes.index).union(changed)
+        index = self.notes_indexes[key]
+        index.remove(removed, old_notes[removed])
+        index.add(added, new_notes[added])
+
+    def _bump(self, key):
+        self.version += 1
+        self.table_versions[key] = self.version
+        return self.version
+
+    def publish(self, key, value):
+        """Replace a table with a session's edited copy."""
+        with self.lock:
+            if key == 'logs':
+                self.log_buffer = AppendableFrame(compact_frame(key, value))
+                value = self.log_buffer.current
+                self.log_index = LogIndex(value)
+                self.last_contact = LastContactTable(value)
+                self.activity = ActivityCube(value)
+            else:
+                value = compact_frame(key, value)
+                if key in DERIVED_COLUMNS:
+                    value = add_derived_columns(key, value)
+            previous, self.tables[key] = self.tables[key], value
+            note_issued_ids(self.backend, key, value)
+            if key in ('production', 'agencies'):
+                self.latest_production = build_latest_production(self.tables['production'], self.tables['agencies'])
+            if key in self.notes_indexes:
+                self._update_notes(key, previous, value)
+            self.entity_indexes.pop(key, None)
+            return self._bump(key)
+
+    def append_logs(self, new_log_df):
+        """
+        Extend the shared log (and its derived tables) in place; returns the new frame and data
+        version. Rows dated before log_since belong to the cold history only (cold_logs reads
+        them back from storage once written), as they would after a restart.
+        """
+        with self.lock:
+            backdated = log_date_mask(new_log_df, None, self.log_since)
+            if backdated.any():
+                # The cached history is now incomplete
+                self.has_cold_logs = True
+                self.cold = None
+                new_log_df = new_log_df[~backdated]
+            if not new_log_df.empty:
+                self.tables['logs'] = self.log_buffer.extend(new_log_df)
+                self.log_index.extend(self.tables['logs'])
+                self.last_contact.update(new_log_df)
+                self.activity.add(new_log_df)
+            return self.tables['logs'], self._bump('logs')
+
+    def upsert_production(self, new_rows):
+        """
+        Replace the production rows of every (Office, Month) in new_rows with new_rows' rows,
+        leaving other periods as they are, and queue a write of just those periods.
+        Returns (table, version, counts) with the inserted/updated/removed counts.
+        """
+        new_rows = apply_schema('production', new_rows)[PRODUCTION_COLUMNS + DERIVED_COLUMNS['production']]
+        periods = set(zip(new_rows['Office'], new_rows['Month']))
+        with self.lock:
+            current = self.tables['production']
+            replaced = period_mask(current, periods)
+            counts = production_changes(current[replaced], new_rows)
+            version = self.publish('production', pd.concat([current[~replaced], new_rows], ignore_index=True))
+            table = self.tables['production']
+        self.queue_production_write(periods)
+        return table, version, counts
+
+    def queue_production_write(self, periods=None):
+        """Queue a write of the given production periods (default: the whole table)."""
+        with self.lock:
+            if periods is None or self.production_dirty is None:
+                self.production_dirty = None
+            else:
+                self.production_dirty |= set(periods)
+        self.writer.save('production', self._write_production)
+
+    def _write_production(self):
+        with self.lock:
+            dirty, table = self.production_dirty, self.tables['production']
+            self.production_dirty = set()
+        try:
+            if dirty is None:
+                self.backend.save('production', table)
+            elif dirty:
+                self.backend.save_production_periods(table, dirty)
+        except Exception:
+            # Still unwritten: merge back into whatever has been queued since
+            with self.lock:
+                if dirty is None or self.production_dirty is None:
+                    self.production_dirty = None
+                else:
+                    self.production_dirty |= dirty
+            raise
+
+    def commit(self, key, value, base, base_version):
+        """
+        Compare-and-swap a session's edited copy of a table. If the table has not changed
+        since the session synced `base` at `base_version`, value replaces it; otherwise the
+        session's row edits are merged into the current table (see merge_table_edit).
+        Returns (table, version, conflicts).
+        """
+        with self.lock:
+            conflicts = []
+            if base is not None and self.table_versions[key] > base_version:
+                value, conflicts = merge_table_edit(key, base, value, self.tables[key])
+            version = self.publish(key, value)
+            return self.tables[key], version, conflicts
+
+    def cold_logs(self):
+        """
+        Activity older than log_since, read from disk the first time a view asks for it.
+        Returns (frame, LogIndex).
+        """
+        cold = self.cold
+        if cold is None:
+            self.writer.flush(['logs'])
+            frame = apply_schema('logs', self.backend.read_logs(before=self.log_since))
+            frame = frame.dropna(subset=['Date']).reset_index(drop=True)
+            with self.lock:
+                tables = dict(self.tables)
+            frame = resolve_log_ids(frame, tables)
+            cold = self.cold = (frame, LogIndex(frame))
+        return cold
+
+    def entity_index(self, key):
+        """The global search index of a table, rebuilt on first use after the table changes."""
+        with self.lock:
+            index = self.entity_indexes.get(key)
+            table = self.tables[key]
+        if index is None:
+            index = EntityIndex(key, table)
+            with self.lock:
+                if self.tables[key] is table:
+                    self.entity_indexes[key] = index
+        return index
+
+    def reload(self, key):
+        """Re-read one table from storage (after an external edit) and publish it."""
+        self.backend.refresh(key)
+        if key == 'logs':
+            self.has_cold_logs = self.backend.has_logs_before(self.log_since)
+            self.cold = None
+        with self.lock:
+            dependencies = dict(self.tables)
+        return self.publish(key, TABLE_LOADERS[key](self.backend, dependencies))
+
+    def changes_since(self, version):
+        """Tables changed after `version`, the current version and the log index."""
+        with self.lock:
+            changed = {
+                key: self.tables[key]
+                for key, table_version in self.table_versions.items()
+                if table_version > version
+            }
+            return changed, self.version, self.log_index
+
+class TableWatcher(threading.Thread):
+    """
+    Background poller that hot-reloads a table when its files change outside the app
+    (e.g. nightly scripts). Changes are keyed on mtime, size and inode; a change must
+    be stable for one extra poll before it is loaded, so half-written files are skipped.
+    """
+
+    def __init__(self, store, backend, interval):
+        super().__init__(name="crm-table-watcher", daemon=True)
+        self.store = store
+        self.backend = backend
+        self.interval = interval
+        self.pending = {}
+
+    def poll(self):
+        for key in FILES:
+            if self.store.writer.is_pending(key):
+                # Our queued write is about to replace the file; look again once it lands
+                continue
+            signature = self.backend.signature(key)
+            if signature == self.backend.known_signatures.get(key):
+                self.pending.pop(key, None)
+                continue
+            if self.pending.get(key) != signature:
+                self.pending[key] = signature
+                continue
+            seen = self.backend.known_signatures.get(key)
+            try:
+                self.store.reload(key)
+            except Exception:
+                # Unreadable (e.g. malformed by the external edit); wait for the next change
+                self.backend.known_signatures[key] = signature
+            else:
+                # Keep the signature the reload recorded: reading can change the files again
+                # (e.g. folding the journal in), which is not a new external edit
+                if self.backend.known_signatures.get(key) == seen:
+                    self.backend.mark_seen(key)
+            self.pending.pop(key, None)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.poll()
+
+class DropFolderWatcher(threading.Thread):
+    """
+    Headless production import from a watched folder (CRM_DROP_DIR). Workbooks and zips
+    saved there are imported like a batch upload once their size and mtime hold for one
+    poll and DROP_SETTLE_SECONDS have passed since the last write: office and month come
+    from the file name, agencies with no likely match are created, and the changes are
+    published to the store, so sessions pick them up on their next rerun. Likely matches
+    with existing agencies wait in match_reviews for an admin (nothing is re-coded
+    unattended). Files then move to done/ or failed/ (with a .error.txt saying why).
+    """
+
+    def __init__(self, store, folder, interval):
+        super().__init__(name="crm-drop-folder", daemon=True)
+        self.store = store
+        self.folder = folder
+        self.interval = interval
+        self.pending = {}
+        self.stuck = {}  # name -> signature of files that could not be moved out; skipped until they change
+        self.reports = []  # latest per-workbook reports, newest last
+        self.match_reviews = {}  # office -> proposals from match_agencies awaiting review (admin sidebar)
+
+    def poll(self):
+        for name in sorted(os.listdir(self.folder)):
+            path = os.path.join(self.folder, name)
+            if name.startswith(('.', '~$')) or not name.lower().endswith(('.xlsx', '.xls', '.zip')) or not os.path.isfile(path):
+                continue
+            signature = file_signature(path)
+            if signature is None or self.stuck.get(name) == signature:
+                continue
+            if self.pending.get(name) != signature or time.time() - signature[0] / 1e9 < DROP_SETTLE_SECONDS:
+                # New or still being copied; import once it has stopped changing
+                self.pending[name] = signature
+                continue
+            self.pending.pop(name, None)
+            self.stuck.pop(name, None)
+            self.ingest(name, path)
+
+    def report(self, rows):
+        self.reports = (self.reports + rows)[-50:]
+
+    def ingest(self, name, path):
+        started = time.perf_counter()
+        try:
+            with open(path, 'rb') as f:
+                upload = io.BytesIO(f.read())
+            upload.name = name
+            with self.store.lock:
+                offices, production = list(self.store.tables['offices']), self.store.tables['production']
+            frames, report = parse_production_batch(expand_import_files([upload]), offices, production)
+            if frames:
+                new_prod = pd.concat(frames, ignore_index=True)
+                self.store.upsert_production(new_prod)
+                self.add_agencies(new_prod)
+        except Exception as e:
+            report = pd.DataFrame([{'File': name, 'Rows': 0, 'Seconds': round(time.perf_counter() - started, 2), 'Status': f"Failed: {e}"}])
+        report = report.assign(Source=name, Imported=datetime.now())
+        self.report(report.to_dict('records'))
+        problems = report[~report['Status'].str.startswith(('Imported', 'Already imported'))]
+        target = os.path.join(self.folder, "failed" if len(problems) else "done")
+        destination = os.path.join(target, name)
+        if os.path.exists(destination):
+            stem, ext = os.path.splitext(name)
+            destination = os.path.join(target, f"{stem}.{datetime.now():%Y%m%d-%H%M%S}{ext}")
+        try:
+            os.makedirs(target, exist_ok=True)
+            os.replace(path, destination)
+        except OSError as e:
+            # E.g. locked by another program: leave it, and skip it until it changes
+            self.stuck[name] = file_signature(path)
+            self.report([{'File': name, 'Rows': 0, 'Seconds': 0.0, 'Status': f"Could not move to {target}: {e}",
+                          'Source': name, 'Imported': datetime.now()}])
+            return
+        if len(problems):
+            with open(destination + ".error.txt", "w", encoding="utf-8") as f:
+                f.writelines(f"{row['File']}: {row['Status']}\n" for _, row in problems.iterrows())
+
+    def add_agencies(self, new_prod):
+        """
+        Create the agencies new_prod introduces that match no existing agency, in one publish.
+        Likely matches are only queued in match_reviews: a wrong one would re-code an agency.
+        """
+        store = self.store
+        with store.lock:
+            agencies, employees = store.tables['agencies'], store.tables['employees']
+            changed = False
+            for office, rows in new_prod.groupby('Office', sort=False):
+                proposals = new_agency_proposals(rows, office, agencies)
+                matched = proposals[proposals['MatchID'] != 0]
+                if not matched.empty:
+                    pending = pd.concat([self.match_reviews.get(office), matched], ignore_index=True)
+                    self.match_reviews[office] = pending.drop_duplicates('AgencyCode', keep='last')
+                created = new_agency_rows(proposals[proposals['MatchID'] == 0], office, agencies, employees)
+                if created.empty:
+                    continue
+                agencies = pd.concat([agencies, created], ignore_index=True)
+                changed = True
+            if not changed:
+                return
+            store.publish('agencies', agencies)
+            table = store.tables['agencies']
+        store.writer.save('agencies', lambda: store.backend.save('agencies', table))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except OSError:
+                # Folder missing or unreadable (e.g. a disconnected share); try again next poll
+                pass
+
+@st.cache_resource
+def get_data_store():
+    """The process-wide store, loaded on first use."""
+    backend = get_storage_backend()
+    store = SharedDataStore(load_data(), backend)
+    if WRITE_DELAY_SECONDS > 0:
+        store.writer.start()
+    atexit.register(store.writer.flush)
+    if WATCH_INTERVAL_SECONDS > 0:
+        store.watcher = TableWatcher(store, backend, WATCH_INTERVAL_SECONDS)
+        store.watcher.start()
+    store.drop_watcher = None
+    if DROP_DIR:
+        os.makedirs(DROP_DIR, exist_ok=True)
+        store.drop_watcher = DropFolderWatcher(store, DROP_DIR, DROP_INTERVAL_SECONDS)
+        store.drop_watcher.start()
+    return store
+
+def sync_session_data():
+    """Point this session at the shared tables, refreshing only those changed since its last rerun."""
+    changed, version, log_index = get_data_store().changes_since(st.session_state.get('data_version', -1))
+    st.session_state.update(changed)
+    st.session_state['data_version'] = version
+    if 'logs' in changed:
+        st.session_state['log_index'] = log_index
+    # The copies this session edits from, for save_to_csv's compare-and-swap
+    synced = st.session_state.setdefault('synced_tables', {})
+    for key, table in changed.items():
+        synced[key] = (table, version)
+
+def find_logs(include_cold=False, **criteria):
+    """
+    This session's activity rows matching criteria (see LogIndex.rows), looked up through
+    the log index rather than by scanning, with the current agency, contact and employee
+    names. include_cold prepends matching rows from before the in-memory window.
+    Rows are labelled by log position (older rows: -1 - position), so results of two
+    lookups can be intersected by index.
+    """
+    logs = st.session_state['log_index'].select(st.session_state['logs'], **criteria)
+    if include_cold:
+        cold, cold_index = get_data_store().cold_logs()
+        cold = cold_index.select(cold, **criteria)
+        logs = pd.concat([cold.set_axis(-1 - cold.index), logs])
+    return with_current_names(logs, st.session_state)
+
+def search_notes(query, limit=50, include_cold=False):
+    """
+    Company-wide notes search through the notes indexes: (log rows, agencies, contacts)
+    matching query, each best match first. include_cold also searches activity from before
+    the in-memory window.
+    """
+    logs = st.session_state['log_index'].search(st.session_state['logs'], query, limit)
+    if include_cold:
+        cold, cold_index = get_data_store().cold_logs()
+        cold = cold_index.search(cold, query, limit)
+        logs = pd.concat([logs, cold.set_axis(-1 - cold.index)])
+        logs = logs.sort_values('Score', ascending=False, kind='stable').head(limit)
+    store = get_data_store()
+    matches = []
+    for key in ('agencies', 'contacts'):
+        table = st.session_state[key]
+        id_col = TABLE_KEYS[key][0]
+        notes_by_id = dict(zip(table[id_col], table['Notes']))
+        ranked = store.notes_indexes[key].search(query, lambda doc: notes_by_id.get(doc, ""))[:limit]
+        rank = {doc: i for i, (doc, _) in enumerate(ranked)}
+        found = table[table[id_col].isin(list(rank))]
+        matches.append(found.iloc[np.argsort(found[id_col].map(rank).to_numpy())])
+    return with_current_names(logs, st.session_state), matches[0], matches[1]
+
+def global_search(query, limit=20):
+    """
+    Agencies, contacts and employees matching a typeahead query, best first: names starting
+    with the query, then shorter names. Columns: Kind, Row (position in that kind's index,
+    unique per kind), ID, AgencyID, Label, Detail, Record (the matched row).
+    """
+    store = get_data_store()
+    indexes = {kind: store.entity_index(key) for kind, key in (('Agency', 'agencies'), ('Contact', 'contacts'), ('Employee', 'employees'))}
+    hits = []
+    for kind, index in indexes.items():
+        positions, tiers, lengths = index.search(query)
+        hits.append(pd.DataFrame({'Kind': kind, 'Row': positions, 'Tier': tiers, 'Length': lengths}))
+    hits = pd.concat(hits, ignore_index=True).sort_values(['Tier', 'Length'], kind='stable').head(limit)
+    agency_names = indexes['Agency'].table.drop_duplicates('AgencyID').set_index('AgencyID')['AgencyName']
+    employees = st.session_state['employees']
+    rows = []
+    for kind, position in zip(hits['Kind'], hits['Row']):
+        record = indexes[kind].table.iloc[position]
+        if kind == 'Agency':
+            detail = f"{record['Office']} · {record['AgencyCode']}" if record['AgencyCode'] else record['Office']
+            rows.append((kind, position, record['AgencyID'], record['AgencyID'], record['AgencyName'], detail, record))
+        elif kind == 'Contact':
+            agency_name = agency_names.get(record['AgencyID'], "")
+            detail = " · ".join(part for part in (agency_name, record['Email']) if part)
+            rows.append((kind, position, record['ContactID'], record['AgencyID'], record['Name'], detail, record))
+        else:
+            offices = employees.loc[employees['Name'] == record['Name'], 'Office']
+            rows.append((kind, position, record['EmployeeID'], None, record['Name'], ", ".join(offices), record))
+    return pd.DataFrame(rows, columns=['Kind', 'Row', 'ID', 'AgencyID', 'Label', 'Detail', 'Record'])
+
 # --- INITIALIZATION ---
-if 'data_initialized' not in st.session_state:
-    loaded_data = load_data()
-    st.session_state.update(loaded_data)
-    st.session_state['data_initialized'] = True
+sync_session_data()
 
 # --- NAVIGATION STATE ---
 if 'view' not in st.session_state:
@@ -527,6 +2993,39 @@ def login_gate():
                 st.error("Invalid username or password.")
     return False
 
+def agency_match_review(reviews, review_office, proposals, key_prefix="", source=""):
+    """Sidebar review of one office's proposed agency matches; applying removes them from `reviews`."""
+    st.sidebar.caption(
+        f"{source}Possible matches with existing {review_office} agencies. Accepted matches give the "
+        "existing agency the imported code; the rest are added as new agencies."
+    )
+    edited = st.sidebar.data_editor(
+        proposals.assign(Accept=proposals['Score'] >= MATCH_ACCEPT_SCORE)[
+            ['Accept', 'AgencyName', 'AgencyCode', 'MatchName', 'MatchCode', 'Score']
+        ],
+        column_config={
+            "AgencyName": "Imported",
+            "AgencyCode": "Code",
+            "MatchName": "Existing agency",
+            "MatchCode": "Existing code",
+            "Score": st.column_config.ProgressColumn("Score", min_value=0, max_value=1, format="%.2f"),
+        },
+        disabled=['AgencyName', 'AgencyCode', 'MatchName', 'MatchCode', 'Score'],
+        hide_index=True,
+        key=f"agency_match_editor_{key_prefix}{review_office}",
+    )
+    mc1, mc2 = st.sidebar.columns(2)
+    apply_selected = mc1.button("Apply selected", key=f"apply_agency_matches_{key_prefix}{review_office}")
+    accept_all = mc2.button("Accept all", key=f"accept_all_agency_matches_{key_prefix}{review_office}")
+    if apply_selected or accept_all:
+        accepted = edited['Accept'].to_numpy() | accept_all
+        apply_agency_matches(proposals[accepted])
+        added = add_imported_agencies(proposals[~accepted], review_office)
+        reviews.pop(review_office, None)
+        st.session_state.pop(f"agency_match_editor_{key_prefix}{review_office}", None)
+        st.sidebar.success(f"Matched {int(accepted.sum())} agencies; added {added} new.")
+        st.rerun()
+
 def admin_sidebar():
     """Render admin tools for managing offices, employees, and production imports."""
     st.sidebar.header("Admin")
@@ -567,19 +3066,10 @@ def admin_sidebar():
                 if not new_offices:
                     st.sidebar.error("Select at least one office.")
                 else:
-                    # Remove current rows for this employee and recreate with selected offices
-                    st.session_state['employees'] = employees_df[employees_df['Name'] != selected_emp]
-                    next_id = get_new_id(st.session_state['employees'], 'EmployeeID')
-                    new_rows = []
-                    for idx, off in enumerate(new_offices):
-                        new_rows.append({
-                            'EmployeeID': next_id + idx,
-                            'Name': selected_emp,
-                            'Office': off
-                        })
-                    new_emp_df = pd.DataFrame(new_rows)
+                    # Replace this employee's rows; logs keep pointing at the same EmployeeID
+                    new_emp_df = employee_office_rows(employees_df, selected_emp, new_offices)
                     st.session_state['employees'] = pd.concat(
-                        [st.session_state['employees'], new_emp_df],
+                        [employees_df[employees_df['Name'] != selected_emp], new_emp_df],
                         ignore_index=True
                     )
                     save_to_csv('employees')
@@ -633,74 +3123,138 @@ def admin_sidebar():
                 if not uploaded_file:
                     st.sidebar.error("Please upload a file.")
                 else:
-                    new_prod = parse_production_excel(uploaded_file, office_choice, month_str)
-                    if not new_prod.empty:
-                        # Replace existing rows for this office+month
-                        existing = st.session_state['production']
-                        mask = ~((existing['Office'] == office_choice) & (existing['Month'] == month_str))
-                        st.session_state['production'] = pd.concat(
-                            [existing[mask], new_prod],
-                            ignore_index=True
+                    new_prod, cached = parse_production_cached(uploaded_file, office_choice, month_str)
+                    if cached and production_period_matches(new_prod, office_choice, month_str, st.session_state['production']):
+                        st.sidebar.info(f"This workbook is already imported for {office_choice} ({month_str}); nothing changed.")
+                    elif not new_prod.empty:
+                        counts = replace_production(new_prod)
+                        st.sidebar.success(
+                            f"Imported {len(new_prod)} production rows for {office_choice} ({month_str}): "
+                            f"{counts['inserted']} new, {counts['updated']} updated, {counts['removed']} removed."
                         )
-                        save_to_csv('production')
-                        st.sidebar.success(f"Imported {len(new_prod)} production rows for {office_choice} ({month_str}); replaced any prior import for that period.")
-
-                        # Add any new agencies from this office that are not already listed
-                        agencies = st.session_state['agencies']
-                        existing_codes = agencies[agencies['Office'] == office_choice]['AgencyCode'] \
-                            .astype(str).str.strip().tolist()
-
-                        # Deduplicate by AgencyCode within this import batch
-                        candidate_agencies = new_prod.copy()
-                        candidate_agencies['AgencyCode'] = candidate_agencies['AgencyCode'].astype(str).str.strip()
-                        candidate_agencies['AgencyName'] = candidate_agencies['AgencyName'].astype(str).str.strip()
-                        candidate_agencies = candidate_agencies.drop_duplicates(subset=['AgencyCode'])
-
-                        missing_mask = ~candidate_agencies['AgencyCode'].isin(existing_codes) & \
-                                       candidate_agencies['AgencyCode'].ne("")
-                        to_add = candidate_agencies[missing_mask]
-
-                        if not to_add.empty:
-                            next_agency_id = get_new_id(agencies, 'AgencyID')
-                            # pick a default underwriter if available
-                            office_emps = st.session_state['employees'][
-                                st.session_state['employees']['Office'] == office_choice
-                            ]
-                            default_uw = office_emps['Name'].iloc[0] if not office_emps.empty else ""
-
-                            new_ag_rows = []
-                            for _, row in to_add.iterrows():
-                                agency_code = row['AgencyCode']
-                                existing_same_code = agencies[agencies['AgencyCode'].astype(str).str.strip() == str(agency_code)]
-                                existing_web = existing_same_code['WebAddress'].iloc[0] if not existing_same_code.empty else ""
-                                existing_notes = existing_same_code['Notes'].iloc[0] if not existing_same_code.empty else ""
-                                agency_id = next_agency_id
-                                next_agency_id += 1
-                                new_ag_rows.append({
-                                    'AgencyID': agency_id,
-                                    'AgencyName': row['AgencyName'],
-                                    'Office': office_choice,
-                                    'WebAddress': existing_web if pd.notna(existing_web) else "",
-                                    'AgencyCode': agency_code,
-                                    'Notes': existing_notes if pd.notna(existing_notes) else "",
-                                    'PrimaryUnderwriter': default_uw
-                                })
-
-                            new_ag_df = pd.DataFrame(new_ag_rows)
-                            st.session_state['agencies'] = pd.concat(
-                                [st.session_state['agencies'], new_ag_df],
-                                ignore_index=True
-                            )
-                            # Deduplicate by AgencyCode+Office to avoid double imports
-                            st.session_state['agencies'] = st.session_state['agencies'].drop_duplicates(
-                                subset=['AgencyCode', 'Office'],
-                                keep='first'
-                            )
-                            save_to_csv('agencies')
-                            st.sidebar.success(f"Added {len(new_ag_df)} new agencies for {office_choice} from import.")
+                        added, queued = import_new_agencies(new_prod, office_choice)
+                        if queued:
+                            st.sidebar.info(f"{queued} imported agencies look like existing ones; review them below.")
+                        if added:
+                            st.sidebar.success(f"Added {added} new agencies for {office_choice} from import.")
                     else:
                         st.sidebar.warning("Import produced no rows. Check the file format and header names.")
 
+        # Batch import: many workbooks (or zips of them), office and month taken from the file names
+        with st.sidebar.form("batch_import_form"):
+            batch_files = st.file_uploader(
+                "Upload workbooks or .zip",
+                type=["xls", "xlsx", "zip"],
+                accept_multiple_files=True,
+                help="Name files by office and month, e.g. SDO_2025-11.xlsx or PHX/Nov 2025.xlsx",
+            )
+            default_office = st.selectbox(
+                "Office when not in the file name", ["(none)"] + list(st.session_state['offices']), key="batch_office_sel"
+            )
+            default_month = st.text_input("Month when not in the file name (YYYY-MM)", key="batch_month")
+            if st.form_submit_button("Import all"):
+                if not batch_files:
+                    st.sidebar.error("Please upload at least one file.")
+                elif default_month and not re.fullmatch(r"20\d{2}-(0[1-9]|1[0-2])", default_month.strip()):
+                    st.sidebar.error("Month must look like 2025-11.")
+                else:
+                    frames, report = parse_production_batch(
+                        expand_import_files(batch_files),
+                        st.session_state['offices'],
+                        st.session_state['production'],
+                        default_office=None if default_office == "(none)" else default_office,
+                        default_month=default_month.strip() or None,
+                    )
+                    if frames:
+                        new_prod = pd.concat(frames, ignore_index=True)
+                        counts = replace_production(new_prod)
+                        st.sidebar.success(
+                            f"Production rows: {counts['inserted']} new, {counts['updated']} updated, "
+                            f"{counts['removed']} removed."
+                        )
+                        added = queued = 0
+                        for office, rows in new_prod.groupby('Office', sort=False):
+                            office_added, office_queued = import_new_agencies(rows, office)
+                            added, queued = added + office_added, queued + office_queued
+                        if queued:
+                            st.sidebar.info(f"{queued} imported agencies look like existing ones; review them below.")
+                        if added:
+                            st.sidebar.success(f"Added {added} new agencies from the batch.")
+                    st.session_state['batch_import_report'] = report
+
+        report = st.session_state.get('batch_import_report')
+        if report is not None:
+            imported = report[report['Rows'] > 0]
+            st.sidebar.caption(
+                f"Batch import: {imported['Rows'].sum()} rows from {len(imported)} of {len(report)} files "
+                f"in {report['Seconds'].sum():.1f}s of parsing."
+            )
+            st.sidebar.dataframe(report, hide_index=True)
+            if st.sidebar.button("Clear report", key="clear_batch_report"):
+                del st.session_state['batch_import_report']
+                st.rerun()
+
+        drop_watcher = get_data_store().drop_watcher
+        if drop_watcher is not None:
+            st.sidebar.caption(
+                f"Drop folder: files saved to {os.path.abspath(drop_watcher.folder)} are imported "
+                f"automatically (checked every {drop_watcher.interval:g}s)."
+            )
+            if drop_watcher.reports:
+                recent = pd.DataFrame(drop_watcher.reports).iloc[::-1]
+                st.sidebar.dataframe(recent[['Imported', 'File', 'Rows', 'Status']], hide_index=True)
+
+        review_sources = [(st.session_state.get('agency_match_reviews', {}), "", "")]
+        if drop_watcher is not None:
+            review_sources.append((drop_watcher.match_reviews, "drop_", "From the drop folder: "))
+        for reviews, key_prefix, source in review_sources:
+            for review_office, proposals in list(reviews.items()):
+                agency_match_review(reviews, review_office, proposals, key_prefix, source)
+
+    # AI response cache
+    with st.sidebar.expander("AI Cache"):
+        ai_cache = get_ai_cache()
+        if ai_cache is None:
+            st.sidebar.caption("AI response cache is off (CRM_AI_CACHE_TTL_HOURS=0).")
+        else:
+            st.sidebar.caption(
+                f"AI responses cached: {len(ai_cache)} of {ai_cache.max_entries} "
+                f"(kept {ai_cache.ttl / 3600:g}h, model {AI_MODEL})"
+            )
+            if st.sidebar.button("Purge AI cache", key="purge_ai_cache"):
+                st.sidebar.success(f"Removed {ai_cache.purge()} cached AI responses.")
+
+    # Storage
+    with st.sidebar.expander("Storage"):
+        backend = get_storage_backend()
+        st.sidebar.caption(f"Storage backend: {backend.name}")
+        writer = get_data_store().writer
+        pending = writer.pending_tables()
+        if pending:
+            st.sidebar.caption(f"Pending writes: {', '.join(pending)}")
+            if st.sidebar.button("Flush now", key="flush_pending_writes"):
+                writer.flush()
+                st.rerun()
+        else:
+            st.sidebar.caption("Pending writes: none")
+        for key, message in dict(writer.errors).items():
+            st.sidebar.error(f"Saving {key} failed (will retry): {message}")
+        if st.sidebar.button("Memory report", key="memory_report"):
+            st.sidebar.dataframe(memory_report(get_data_store().tables), hide_index=True)
+        if backend.name != "csv" and st.sidebar.button("Export CSV snapshot", key="export_csv_snapshot"):
+            export_tables_to_csv()
+            st.sidebar.success("Exported all tables to crm_*.csv.")
+
+def show_save_conflicts():
+    """Report rows from this session's last saves that another user had changed first."""
+    conflicts = st.session_state.pop('save_conflicts', [])
+    if conflicts:
+        st.warning(
+            "Some changes were not saved because another user edited the same records first; "
+            "their version is shown. Re-apply your edit if it is still needed:\n\n"
+            + "\n".join(f"- {c}" for c in conflicts)
+        )
+
 # --- NAV HELPERS ---
 def go_to_office(name):
     st.session_state['view'] = 'office'
@@ -723,7 +3277,116 @@ def go_to_contact(contact_id, agency_id=None):
         if not match.empty:
             st.session_state['selected_agency'] = match.iloc[0].to_dict()
 
+# --- GLOBAL SEARCH ---
+def global_search_sidebar():
+    """Sidebar search across every agency, contact and employee, linking to each match."""
+    query = st.sidebar.text_input(
+        "Search",
+        key="global_search_input",
+        placeholder="Agency, code, contact, email or employee",
+    )
+    if not tokenize(query):
+        return
+    hits = global_search(query)
+    if hits.empty:
+        st.sidebar.caption("No matches.")
+    for _, hit in hits.iterrows():
+        label = f"{hit['Kind']}: {hit['Label']}" + (f" ({hit['Detail']})" if hit['Detail'] else "")
+        if st.sidebar.button(label, key=f"global_hit_{hit['Kind']}_{hit['Row']}"):
+            if hit['Kind'] == 'Agency':
+                go_to_agency(hit['Record'])
+            elif hit['Kind'] == 'Contact':
+                go_to_contact(int(hit['ID']), int(hit['AgencyID']))
+            else:
+                go_to_employee(hit['Label'])
+            st.rerun()
+
 # --- AI HELPERS (optional OpenAI integration) ---
+AI_MODEL = os.environ.get("CRM_AI_MODEL", "gpt-4o-mini")
+AI_CACHE_PATH = os.environ.get("CRM_AI_CACHE_PATH", "crm_ai_cache.db")
+AI_CACHE_ENTRIES = int(os.environ.get("CRM_AI_CACHE_ENTRIES", "500"))  # least recently used evicted past this
+AI_CACHE_TTL_SECONDS = float(os.environ.get("CRM_AI_CACHE_TTL_HOURS", "168")) * 3600  # 0 disables the cache
+
+class AIResponseCache:
+    """
+    Completions in a small SQLite file, keyed by a hash of everything that shapes the answer
+    (model, system prompt, prompt, temperature, max_tokens). Entries expire `ttl` seconds
+    after they were created; past `max_entries` the least recently used are evicted.
+    The file is opened (and created) on the first get/put, not when the cache is constructed.
+    """
+
+    def __init__(self, path, max_entries, ttl):
+        self.lock = threading.Lock()
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.conn = None
+
+    def _open(self, create=True):
+        """The connection, opened on first use; None if create is False and there is no file yet."""
+        if self.conn is None and (create or os.path.exists(self.path)):
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            with self.conn:
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS responses "
+                    "(key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, used REAL NOT NULL)"
+                )
+                self.conn.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        return self.conn
+
+    @staticmethod
+    def key(model, system_prompt, prompt, temperature, max_tokens):
+        parts = [model, system_prompt or "", prompt, repr(float(temperature)), str(int(max_tokens))]
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """The cached response for key, or None if there is none or it has expired."""
+        now = time.time()
+        with self.lock, self._open():
+            row = self.conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] + self.ttl <= now:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self.conn.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        with self.lock, self._open():
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created, used) VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            self.conn.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl,))
+            self.conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def purge(self):
+        """Drop every cached response; returns how many there were."""
+        with self.lock:
+            if self._open(create=False) is None:
+                return 0
+            with self.conn:
+                return self.conn.execute("DELETE FROM responses").rowcount
+
+    def __len__(self):
+        with self.lock:
+            if self._open(create=False) is None:
+                return 0
+            return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+@st.cache_resource
+def get_ai_cache():
+    """The process-wide AI response cache, or None when disabled (CRM_AI_CACHE_TTL_HOURS=0)."""
+    if AI_CACHE_TTL_SECONDS <= 0 or AI_CACHE_ENTRIES <= 0:
+        return None
+    return AIResponseCache(AI_CACHE_PATH, AI_CACHE_ENTRIES, AI_CACHE_TTL_SECONDS)
+
 def ai_client_available():
     """Return True if OpenAI API key and library are available."""
     if not os.environ.get("OPENAI_API_KEY"):
@@ -734,14 +3397,25 @@ def ai_client_available():
         return False
     return True
 
-def run_ai_prompt(prompt, system_prompt=None, temperature=0.2, max_tokens=600):
+def run_ai_prompt(prompt, system_prompt=None, temperature=0.2, max_tokens=600, use_cache=True):
     """
     Fire a lightweight chat completion against OpenAI if configured.
+    An identical request answered within the cache TTL is served from the response cache;
+    use_cache=False always asks the model (and caches the new answer).
     Returns (text, error). Does not throw.
     """
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
         return None, "Set OPENAI_API_KEY to enable in-app ChatGPT."
+    cache = get_ai_cache()
+    cache_key = AIResponseCache.key(AI_MODEL, system_prompt, prompt, temperature, max_tokens)
+    if cache is not None and use_cache:
+        try:
+            cached = cache.get(cache_key)
+        except sqlite3.Error:
+            cached = None
+        if cached is not None:
+            return cached, None
     try:
         from openai import OpenAI
     except ImportError:
@@ -754,12 +3428,17 @@ def run_ai_prompt(prompt, system_prompt=None, temperature=0.2, max_tokens=600):
             messages.append({"role": "system", "content": system_prompt})
         messages.append({"role": "user", "content": prompt})
         resp = client.chat.completions.create(
-            model="gpt-4o-mini",
+            model=AI_MODEL,
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
         )
         text = resp.choices[0].message.content
+        if cache is not None and text:
+            try:
+                cache.put(cache_key, text)
+            except sqlite3.Error:
+                pass  # a cache write failure must not lose the answer
         return text, None
     except Exception as e:
         return None, f"AI call failed: {e}"
@@ -836,32 +3515,24 @@ def parse_contact_block(text_block):
     return name, role, email, phone, linkedin
 
 # --- HELPER FUNCTION: GET LAST CONTACT DATE ---
-def get_last_contact_status(contact_name, agency_name=None):
+def get_last_contact_status(contact_id):
     """
     Returns (status_text, is_stale_over_90d).
     Treat missing/never-contacted as stale.
     """
-    logs = st.session_state['logs']
-    contact_logs = logs[logs['ContactName'] == contact_name].copy()
-    if agency_name:
-        contact_logs = contact_logs[contact_logs['AgencyName'] == agency_name]
+    store = get_data_store()
+    last = store.last_contact.get(contact_id)
 
     today = datetime.now().date()
 
-    if contact_logs.empty:
+    if last is None:
+        if store.has_cold_logs:
+            # Only recent months are in memory; anything older is over 90 days anyway
+            return f"Status: no contact since {store.log_since:%Y-%m-%d}", True
         return "Status: never contacted", True
 
     try:
-        valid_logs = contact_logs.dropna(subset=['Date'])
-        if valid_logs.empty:
-            return "Status: no valid log dates found", True
-
-        valid_logs['Date'] = pd.to_datetime(valid_logs['Date'], errors='coerce')
-        valid_logs = valid_logs.dropna(subset=['Date'])
-        if valid_logs.empty:
-            return "Status: no valid log dates found", True
-
-        last_date_dt = valid_logs['Date'].max().date()
+        last_date_dt = last[0].date()
         days_diff = (today - last_date_dt).days
         last_contact_str = last_date_dt.strftime("%Y-%m-%d")
 
@@ -875,10 +3546,32 @@ def get_last_contact_status(contact_name, agency_name=None):
     except Exception as e:
         return f"Status error: {e}", True
 
+# --- HELPER FUNCTION: ACTIVITY COUNTS ---
+def employee_activity_counts(names):
+    """
+    Calls_30d, Emails_30d, Calls_YTD and Emails_YTD per employee name (indexed by Name),
+    summed from the store's daily activity cube instead of scanning the log. Activity logged
+    under a name that resolved to no EmployeeID counts for that name.
+    """
+    employees = st.session_state['employees']
+    cube = get_data_store().activity
+    today = datetime.now().date()
+    windows = {
+        'Calls_30d': ('Call', today - timedelta(days=30)),
+        'Emails_30d': ('Email', today - timedelta(days=30)),
+        'Calls_YTD': ('Call', date(today.year, 1, 1)),
+        'Emails_YTD': ('Email', date(today.year, 1, 1)),
+    }
+    counts = pd.DataFrame(0, index=pd.Index(names, name='Name').unique(), columns=list(windows))
+    rows = employees[employees['Name'].isin(counts.index)]
+    for employee, name in [*zip(rows['EmployeeID'], rows['Name']), *zip(counts.index, counts.index)]:
+        for col, (kind, since) in windows.items():
+            counts.at[name, col] += cube.total(employee, kind, since)
+    return counts
+
 # --- VIEW: COMPANY (Level 1) ---
 def view_company():
     st.title("Company Dashboard")
-    logs = st.session_state['logs']
     employees = st.session_state['employees']
 
     # Base stats frame: one row per employee (aggregate offices to avoid duplicates)
@@ -895,80 +3588,25 @@ def view_company():
     for col in metrics_cols:
         stats[col] = 0
 
-    if not logs.empty and 'Date' in logs.columns:
-        logs_dt = logs.copy()
-        logs_dt['Date'] = pd.to_datetime(logs_dt['Date'], errors='coerce')
-        logs_dt = logs_dt.dropna(subset=['Date'])
-        if not logs_dt.empty:
-            logs_dt['DateOnly'] = logs_dt['Date'].dt.date
-            today = datetime.now().date()
-            cutoff_30 = today - timedelta(days=30)
-            start_year = date(today.year, 1, 1)
-
-            mask_30 = logs_dt['DateOnly'] >= cutoff_30
-            mask_ytd = logs_dt['DateOnly'] >= start_year
-
-            calls_30 = logs_dt[mask_30 & (logs_dt['Type'] == 'Call')] \
-                .groupby('EmployeeName').size().reset_index(name='Calls_30d')
-            emails_30 = logs_dt[mask_30 & (logs_dt['Type'] == 'Email')] \
-                .groupby('EmployeeName').size().reset_index(name='Emails_30d')
-            calls_ytd = logs_dt[mask_ytd & (logs_dt['Type'] == 'Call')] \
-                .groupby('EmployeeName').size().reset_index(name='Calls_YTD')
-            emails_ytd = logs_dt[mask_ytd & (logs_dt['Type'] == 'Email')] \
-                .groupby('EmployeeName').size().reset_index(name='Emails_YTD')
-
-            stats = stats.set_index('Name')
-
-            def add_counts(df_counts, col_name):
-                if df_counts.empty:
-                    return
-                series = df_counts.set_index('EmployeeName')[col_name]
-                stats[col_name] = stats[col_name].add(series, fill_value=0)
-
-            add_counts(calls_30, 'Calls_30d')
-            add_counts(emails_30, 'Emails_30d')
-            add_counts(calls_ytd, 'Calls_YTD')
-            add_counts(emails_ytd, 'Emails_YTD')
-
-            stats = stats.reset_index()
-            for col in metrics_cols:
-                stats[col] = stats[col].fillna(0).astype(int)
+    if not stats.empty:
+        counts = employee_activity_counts(stats['Name'])
+        for col in counts.columns:
+            stats[col] = stats['Name'].map(counts[col]).fillna(0).astype(int)
 
     # Add production-based metrics (YTD premium and new business count) per underwriter
-    prod_df = st.session_state.get('production', pd.DataFrame())
     tasks_df = st.session_state.get('tasks', pd.DataFrame())
-    agencies_df = st.session_state.get('agencies', pd.DataFrame())
-    if not prod_df.empty and not agencies_df.empty:
-        prod = prod_df.copy()
-        prod['AgencyCode'] = prod['AgencyCode'].astype(str).str.strip()
-        prod['Month_dt'] = pd.to_datetime(prod['Month'], format="%Y-%m", errors='coerce')
-        prod = prod.dropna(subset=['Month_dt', 'AgencyCode'])
-
-        if not prod.empty:
-            idx = prod.groupby('AgencyCode')['Month_dt'].idxmax()
-            latest_prod = prod.loc[idx].copy()
-
-            agencies_norm = agencies_df.copy()
-            agencies_norm['AgencyCode'] = agencies_norm['AgencyCode'].astype(str).str.strip()
-
-            uw_prod = latest_prod.merge(
-                agencies_norm[['AgencyCode', 'PrimaryUnderwriter']],
-                on='AgencyCode',
-                how='left'
-            )
-            uw_prod = uw_prod.dropna(subset=['PrimaryUnderwriter'])
-
-            if not uw_prod.empty:
-                by_uw = uw_prod.groupby('PrimaryUnderwriter')[['AllYTDWP', 'AllYTDNB']].sum()
-                stats = stats.set_index('Name')
-                # Ensure float for premium, int for count
-                if 'YTD_WP' not in stats.columns:
-                    stats['YTD_WP'] = 0.0
-                if 'YTD_NB' not in stats.columns:
-                    stats['YTD_NB'] = 0
-                stats['YTD_WP'] = stats['YTD_WP'].add(by_uw['AllYTDWP'], fill_value=0)
-                stats['YTD_NB'] = stats['YTD_NB'].add(by_uw['AllYTDNB'], fill_value=0).astype(int)
-                stats = stats.reset_index()
+    uw_prod = get_data_store().latest_production.dropna(subset=['PrimaryUnderwriter'])
+    if not uw_prod.empty:
+        by_uw = uw_prod.groupby('PrimaryUnderwriter')[['AllYTDWP', 'AllYTDNB']].sum()
+        stats = stats.set_index('Name')
+        # Ensure float for premium, int for count
+        if 'YTD_WP' not in stats.columns:
+            stats['YTD_WP'] = 0.0
+        if 'YTD_NB' not in stats.columns:
+            stats['YTD_NB'] = 0
+        stats['YTD_WP'] = stats['YTD_WP'].add(by_uw['AllYTDWP'], fill_value=0)
+        stats['YTD_NB'] = stats['YTD_NB'].add(by_uw['AllYTDNB'], fill_value=0).astype(int)
+        stats = stats.reset_index()
 
     # Sort employees by most calls in last 30 days
     stats = stats.sort_values(by='Calls_30d', ascending=False, kind='mergesort')
@@ -1052,11 +3690,50 @@ def view_company():
                 st.rerun()
     st.markdown('</div>', unsafe_allow_html=True)
 
+    # Company-wide notes search (activity, agency and contact notes)
+    st.markdown('<div class="panel panel-activity">', unsafe_allow_html=True)
+    st.subheader("Search Notes")
+    query = st.text_input(
+        "Keywords, \"exact phrase\" or prefix*",
+        key="company_notes_search",
+        placeholder='e.g. renewal "new business" quot*',
+    )
+    store = get_data_store()
+    include_cold = store.has_cold_logs and st.checkbox(
+        f"Include activity before {store.log_since:%Y-%m-%d}", key="company_cold_logs"
+    )
+    if query:
+        log_hits, agency_hits, contact_hits = search_notes(query, include_cold=include_cold)
+        if log_hits.empty and agency_hits.empty and contact_hits.empty:
+            st.info("No notes match this search.")
+        if not log_hits.empty:
+            st.caption(f"Activity ({len(log_hits)} best matches)")
+            st.dataframe(
+                log_hits[['Date', 'AgencyName', 'ContactName', 'EmployeeName', 'Type', 'Notes']],
+                column_config={
+                    "Date": st.column_config.DatetimeColumn("Date", format="YYYY-MM-DD HH:mm"),
+                },
+                hide_index=True,
+                use_container_width=True
+            )
+        if not agency_hits.empty:
+            st.caption("Agencies")
+            for idx, arow in agency_hits.iterrows():
+                if st.button(f"{arow['AgencyName']} ({arow['Office']}): {arow['Notes'][:80]}", key=f"notes_ag_{idx}"):
+                    go_to_agency(arow)
+                    st.rerun()
+        if not contact_hits.empty:
+            st.caption("Contacts")
+            for idx, crow in contact_hits.iterrows():
+                if st.button(f"{crow['Name']}: {crow['Notes'][:80]}", key=f"notes_ct_{idx}"):
+                    go_to_contact(crow['ContactID'], crow['AgencyID'])
+                    st.rerun()
+    st.markdown('</div>', unsafe_allow_html=True)
+
 # --- VIEW: OFFICE (Level 2) ---
 def view_office():
     office = st.session_state['selected_office']
     employees = st.session_state['employees']
-    logs = st.session_state['logs']
     employees_in_office = employees[employees['Office'] == office]['Name'].tolist()
 
     st.button("Back to Company", on_click=lambda: st.session_state.update({'view': 'company'}))
@@ -1074,44 +3751,10 @@ def view_office():
         for col in metrics_cols:
             office_emp_df[col] = 0
 
-        if not logs.empty and not office_emp_df.empty:
-            office_logs = logs[logs['EmployeeName'].isin(office_emp_df['Name'])].copy()
-            office_logs['Date'] = pd.to_datetime(office_logs['Date'], errors='coerce')
-            office_logs = office_logs.dropna(subset=['Date'])
-            if not office_logs.empty:
-                office_logs['DateOnly'] = office_logs['Date'].dt.date
-                today = datetime.now().date()
-                cutoff_30 = today - timedelta(days=30)
-                start_year = date(today.year, 1, 1)
-
-                mask_30 = office_logs['DateOnly'] >= cutoff_30
-                mask_ytd = office_logs['DateOnly'] >= start_year
-
-                calls_30 = office_logs[mask_30 & (office_logs['Type'] == 'Call')] \
-                    .groupby('EmployeeName').size().reset_index(name='Calls_30d')
-                emails_30 = office_logs[mask_30 & (office_logs['Type'] == 'Email')] \
-                    .groupby('EmployeeName').size().reset_index(name='Emails_30d')
-                calls_ytd = office_logs[mask_ytd & (office_logs['Type'] == 'Call')] \
-                    .groupby('EmployeeName').size().reset_index(name='Calls_YTD')
-                emails_ytd = office_logs[mask_ytd & (office_logs['Type'] == 'Email')] \
-                    .groupby('EmployeeName').size().reset_index(name='Emails_YTD')
-
-                office_emp_df = office_emp_df.set_index('Name')
-
-                def add_counts(df_counts, col_name):
-                    if df_counts.empty:
-                        return
-                    series = df_counts.set_index('EmployeeName')[col_name]
-                    office_emp_df[col_name] = office_emp_df[col_name].add(series, fill_value=0)
-
-                add_counts(calls_30, 'Calls_30d')
-                add_counts(emails_30, 'Emails_30d')
-                add_counts(calls_ytd, 'Calls_YTD')
-                add_counts(emails_ytd, 'Emails_YTD')
-
-                office_emp_df = office_emp_df.reset_index()
-                for col in metrics_cols:
-                    office_emp_df[col] = office_emp_df[col].fillna(0).astype(int)
+        if not office_emp_df.empty:
+            counts = employee_activity_counts(office_emp_df['Name'])
+            for col in metrics_cols:
+                office_emp_df[col] = office_emp_df['Name'].map(counts[col]).fillna(0).astype(int)
 
         stats_office = office_emp_df
 
@@ -1261,11 +3904,10 @@ def view_office():
     if prod_df.empty:
         st.info("No production data has been uploaded yet.")
     else:
-        office_prod = prod_df[prod_df['Office'] == office].copy()
+        office_prod = prod_df[prod_df['Office'] == office]
         if office_prod.empty:
             st.info("No production data for this office yet.")
         else:
-            office_prod['Month_dt'] = pd.to_datetime(office_prod['Month'], format="%Y-%m", errors='coerce')
             office_prod = office_prod.dropna(subset=['Month_dt'])
             if office_prod.empty:
                 st.info("Production data found, but months could not be parsed.")
@@ -1305,15 +3947,11 @@ def view_office():
     st.markdown('<div class="panel panel-activity">', unsafe_allow_html=True)
     st.subheader("Recent Activity")
 
-    agency_names_in_office = agencies[agencies['Office'] == office]['AgencyName'].tolist()
+    agency_ids_in_office = agencies[agencies['Office'] == office]['AgencyID'].tolist()
 
-    office_logs = st.session_state['logs'][
-        st.session_state['logs']['AgencyName'].isin(agency_names_in_office)
-    ].copy()
+    office_logs = find_logs(agency=agency_ids_in_office).copy()
 
     if not office_logs.empty:
-        office_logs['Date'] = pd.to_datetime(office_logs['Date'], errors='coerce')
-        office_logs.dropna(subset=['Date'], inplace=True)
         office_logs.sort_values(by='Date', ascending=False, inplace=True)
 
         st.dataframe(
@@ -1439,14 +4077,11 @@ def view_agency():
             top_right.markdown("_No contact emails available_")
 
     # PRODUCTION SUMMARY (no history graph, now in a row)
-    prod_df = st.session_state.get('production', pd.DataFrame())
+    latest_production = get_data_store().latest_production
     agency_code = str(agency_dict.get('AgencyCode', "")).strip()
-    if not prod_df.empty and agency_code:
-        prod_match = prod_df[prod_df['AgencyCode'].astype(str).str.strip() == agency_code].copy()
+    if agency_code:
+        prod_match = latest_production[latest_production['AgencyCode'] == agency_code]
         if not prod_match.empty:
-            prod_match['Month_dt'] = pd.to_datetime(prod_match['Month'], format="%Y-%m", errors='coerce')
-            prod_match = prod_match.sort_values('Month_dt', ascending=False)
-
             latest = prod_match.iloc[0]
             st.markdown('<div class="panel panel-prod">', unsafe_allow_html=True)
             st.subheader("Production Summary")
@@ -1465,9 +4100,8 @@ def view_agency():
             c4.metric("YTD NB", int(latest['AllYTDNB']))
             c5.metric("PYTD NB", int(latest.get('PYTDNB', latest.get('PYTotalNB', 0))))
 
-            if len(prod_match) >= 2:
-                prev = prod_match.iloc[1]
-                delta = latest['AllYTDWP'] - prev['AllYTDWP']
+            if pd.notna(latest['PrevAllYTDWP']):
+                delta = latest['AllYTDWP'] - latest['PrevAllYTDWP']
                 if delta > 0:
                     trend_text = f"Increasing (+${delta:,.0f} vs prior month)"
                 elif delta < 0:
@@ -1509,7 +4143,7 @@ def view_agency():
             e_notes = st.text_area("Notes", value=agency_dict.get('Notes', ''))
 
             if st.form_submit_button("Save Changes"):
-                agencies = st.session_state['agencies']
+                agencies = st.session_state['agencies'].copy()
                 index_to_update = agencies[agencies['AgencyID'] == agency_id].index[0]
 
                 agencies.loc[index_to_update, 'AgencyName'] = e_name
@@ -1518,6 +4152,7 @@ def view_agency():
                 agencies.loc[index_to_update, 'Notes'] = e_notes
                 agencies.loc[index_to_update, 'PrimaryUnderwriter'] = e_uw 
 
+                st.session_state['agencies'] = agencies
                 st.session_state['selected_agency'] = agencies.loc[index_to_update].to_dict()
                 save_to_csv('agencies')
                 st.success("Agency details updated.")
@@ -1588,13 +4223,15 @@ def view_agency():
 
                     col_save, col_cancel = st.columns(2)
                     if col_save.form_submit_button("Save"):
-                        contact_index_to_update = st.session_state['contacts'][
-                            st.session_state['contacts']['ContactID'] == contact_id
+                        contacts_upd = st.session_state['contacts'].copy()
+                        contact_index_to_update = contacts_upd[
+                            contacts_upd['ContactID'] == contact_id
                         ].index[0]
-                        st.session_state['contacts'].loc[
+                        contacts_upd.loc[
                             contact_index_to_update,
                             ['Name', 'Role', 'Email', 'Phone', 'LinkedIn', 'Notes', 'Preferences']
                         ] = [e_cn, e_cr, e_ce, e_cp, e_cl, e_c_notes, e_c_pref]
+                        st.session_state['contacts'] = contacts_upd
                         st.session_state['editing_contact_id'] = None
                         save_to_csv('contacts')
                         st.success("Contact updated.")
@@ -1606,7 +4243,7 @@ def view_agency():
                 cca, ccb, ccc, ccd = st.columns([3, 1, 1, 1])
                 cca.markdown(f"**{row['Name']}** ({row['Role']})")
 
-                last_contact_status, is_stale = get_last_contact_status(contact_name, agency_dict['AgencyName'])
+                last_contact_status, is_stale = get_last_contact_status(contact_id)
                 email_display = (
                     f"Email: [{row['Email']}](mailto:{row['Email']})"
                     if row.get('Email') else "Email: none"
@@ -1654,11 +4291,13 @@ def view_agency():
             key=f"log_emps_{agency_id}"
         )
 
-        contact_options = ag_contacts['Name'].tolist()
+        contact_options = ag_contacts['ContactID'].tolist()
+        contact_names = dict(zip(ag_contacts['ContactID'], ag_contacts['Name']))
         contacts_selected = st.multiselect(
             "Contacts",
             options=contact_options,
             default=contact_options[:1] if contact_options else [],
+            format_func=lambda cid: contact_names.get(cid, str(cid)),
             key=f"log_contacts_{agency_id}"
         )
 
@@ -1678,24 +4317,23 @@ def view_agency():
                 log_datetime = datetime.combine(log_date, datetime.now().time())
                 timestamp_str = log_datetime.strftime("%Y-%m-%d %H:%M:%S")
 
+                emp_ids = employee_ids(st.session_state['employees'])
                 new_rows = []
                 for emp in employees_selected:
                     for ct in contacts_selected:
                         new_rows.append({
                             'Date': timestamp_str,
+                            'EmployeeID': emp_ids.get(emp, 0),
+                            'AgencyID': agency_id,
+                            'ContactID': ct,
+                            'Type': type_,
+                            'Notes': notes,
                             'EmployeeName': emp,
                             'AgencyName': agency_dict['AgencyName'],
-                            'ContactName': ct,
-                            'Type': type_,
-                            'Notes': notes
+                            'ContactName': contact_names.get(ct, ""),
                         })
 
-                new_log_df = pd.DataFrame(new_rows)
-                st.session_state['logs'] = pd.concat(
-                    [st.session_state['logs'], new_log_df],
-                    ignore_index=True
-                )
-                save_to_csv('logs')
+                append_logs(new_rows)
                 st.success(f"Logged {len(new_rows)} activities.")
                 for k in [f"log_emps_{agency_id}", f"log_contacts_{agency_id}", f"log_notes_{agency_id}"]:
                     st.session_state.pop(k, None)
@@ -1706,14 +4344,13 @@ def view_agency():
     st.markdown('<div class="panel panel-logs">', unsafe_allow_html=True)
     st.subheader("Activity History")
 
-    agency_logs = st.session_state['logs'][
-        st.session_state['logs']['AgencyName'] == agency_dict['AgencyName']
-    ].copy()
+    store = get_data_store()
+    include_cold = store.has_cold_logs and st.checkbox(
+        f"Include activity before {store.log_since:%Y-%m-%d}", key="agency_cold_logs"
+    )
+    agency_logs = find_logs(include_cold=include_cold, agency=agency_dict['AgencyID']).copy()
 
     if not agency_logs.empty:
-        agency_logs['Date'] = pd.to_datetime(agency_logs['Date'], errors='coerce')
-        agency_logs.dropna(subset=['Date'], inplace=True)
-
         filter_col1, filter_col2, filter_col3 = st.columns([1, 1, 2])
 
         unique_contacts = ['All Contacts'] + agency_logs['ContactName'].unique().tolist()
@@ -1728,10 +4365,11 @@ def view_agency():
 
         search_term = filter_col3.text_input("Search Employee/Notes/Keywords")
         if search_term:
-            search_term = search_term.lower()
+            # Notes through the notes index; employee names are few enough to match directly
+            note_hits = find_logs(include_cold=include_cold, agency=agency_dict['AgencyID'], notes=search_as_typed(search_term))
             agency_logs = agency_logs[
-                agency_logs['Notes'].astype(str).str.lower().str.contains(search_term, na=False) |
-                agency_logs['EmployeeName'].astype(str).str.lower().str.contains(search_term, na=False)
+                agency_logs.index.isin(note_hits.index) |
+                agency_logs['EmployeeName'].astype(str).str.lower().str.contains(search_term.lower(), regex=False, na=False)
             ]
 
         agency_logs.sort_values(by='Date', ascending=False, inplace=True)
@@ -1782,12 +4420,16 @@ def view_contact():
         st.title(contact.get('Name', 'Contact'))
         role_text = contact.get('Role', '')
         st.caption(f"{role_text} @ {agency_name}" if role_text else agency_name)
-        status_text, is_stale = get_last_contact_status(contact.get('Name', ''), agency_name if agency is not None else None)
+        status_text, is_stale = get_last_contact_status(contact_id)
         if is_stale:
             status_html = f"<span style='background-color:#ffe5e5;color:#9b1b1b;padding:2px 6px;border-radius:4px;'>{status_text}</span>"
             st.markdown(status_html, unsafe_allow_html=True)
         else:
             st.markdown(status_text)
+        last = get_data_store().last_contact.get(contact_id)
+        if last is not None:
+            employee_names = dict(zip(st.session_state['employees']['EmployeeID'], st.session_state['employees']['Name']))
+            st.caption(f"Last activity: {last[1]} by {employee_names.get(last[2], 'unknown')}")
     with top_right:
         st.markdown(f"**Office:** {office or 'N/A'}")
         if contact.get('Email'):
@@ -1800,11 +4442,8 @@ def view_contact():
     st.markdown('<div class="panel panel-activity">', unsafe_allow_html=True)
     with st.expander("AI: Draft an email to this contact"):
         pref = contact.get('Preferences', '')
-        recent_logs = st.session_state.get('logs', pd.DataFrame())
-        if not recent_logs.empty:
-            contact_logs = recent_logs[recent_logs['ContactName'] == contact.get('Name', '')].copy()
-            if agency_name:
-                contact_logs = contact_logs[contact_logs['AgencyName'] == agency_name]
+        contact_logs = find_logs(contact=contact_id)
+        if not contact_logs.empty:
             contact_logs = contact_logs.sort_values('Date', ascending=False).head(5)
             history_snippet = "\n".join(
                 f"- {row['Date']} {row['Type']} by {row['EmployeeName']}: {row['Notes']}"
@@ -1881,10 +4520,17 @@ def view_contact():
             )
 
         if ai_client_available():
-            if st.button("Generate draft", key=f"ai_gen_{contact_id}"):
+            gen1, gen2 = st.columns([1, 1])
+            generate = gen1.button("Generate draft", key=f"ai_gen_{contact_id}")
+            regenerate = gen2.button("New variation", key=f"ai_regen_{contact_id}", help="Ask again instead of reusing an identical earlier draft")
+            if generate or regenerate:
                 prompt = build_prompt()
                 with st.spinner("Calling OpenAI..."):
-                    draft, err = run_ai_prompt(prompt, system_prompt="You are a concise insurance marketing outreach assistant.")
+                    draft, err = run_ai_prompt(
+                        prompt,
+                        system_prompt="You are a concise insurance marketing outreach assistant.",
+                        use_cache=not regenerate,
+                    )
                 if err or not draft:
                     msg = err or "No text returned from AI."
                     st.warning(f"{msg}\nShowing the prompt below so you can copy/paste into ChatGPT.")
@@ -1946,23 +4592,22 @@ def view_contact():
             else:
                 log_datetime = datetime.combine(log_date, datetime.now().time())
                 timestamp_str = log_datetime.strftime("%Y-%m-%d %H:%M:%S")
+                emp_ids = employee_ids(employees_df)
                 new_rows = []
                 contact_name = contact.get('Name', '')
                 for emp in employees_selected:
                     new_rows.append({
                         'Date': timestamp_str,
+                        'EmployeeID': emp_ids.get(emp, 0),
+                        'AgencyID': contact.get('AgencyID', 0),
+                        'ContactID': contact_id,
+                        'Type': log_type,
+                        'Notes': log_notes,
                         'EmployeeName': emp,
-                        'AgencyName': agency_name,
+                        'AgencyName': agency_name if agency is not None else "",
                         'ContactName': contact_name,
-                        'Type': log_type,
-                        'Notes': log_notes
                     })
-                new_log_df = pd.DataFrame(new_rows)
-                st.session_state['logs'] = pd.concat(
-                    [st.session_state['logs'], new_log_df],
-                    ignore_index=True
-                )
-                save_to_csv('logs')
+                append_logs(new_rows)
                 st.success(f"Logged {len(new_rows)} {log_type.lower()} record(s) for this contact.")
                 st.rerun()
     st.markdown('</div>', unsafe_allow_html=True)
@@ -1970,43 +4615,39 @@ def view_contact():
     # Activity history for this contact
     st.markdown('<div class="panel panel-logs">', unsafe_allow_html=True)
     st.subheader("Activity History")
-    logs_df = st.session_state.get('logs', pd.DataFrame())
-    if logs_df.empty:
+    store = get_data_store()
+    include_cold = store.has_cold_logs and st.checkbox(
+        f"Include activity before {store.log_since:%Y-%m-%d}", key="contact_cold_logs"
+    )
+    contact_logs = find_logs(include_cold=include_cold, contact=contact_id)
+    if contact_logs.empty:
         st.info("No activity logged for this contact yet.")
     else:
-        contact_logs = logs_df[logs_df['ContactName'] == contact.get('Name', '')].copy()
-        if agency_name:
-            contact_logs = contact_logs[contact_logs['AgencyName'] == agency_name]
-        contact_logs['Date'] = pd.to_datetime(contact_logs['Date'], errors='coerce')
-        contact_logs = contact_logs.dropna(subset=['Date'])
-        if contact_logs.empty:
-            st.info("No activity logged for this contact yet.")
-        else:
-            contact_logs = contact_logs.sort_values('Date', ascending=False)
-            call_count = (contact_logs['Type'] == 'Call').sum()
-            email_count = (contact_logs['Type'] == 'Email').sum()
-            st.markdown(f"Calls: **{call_count}** | Emails: **{email_count}**")
+        contact_logs = contact_logs.sort_values('Date', ascending=False)
+        call_count = (contact_logs['Type'] == 'Call').sum()
+        email_count = (contact_logs['Type'] == 'Email').sum()
+        st.markdown(f"Calls: **{call_count}** | Emails: **{email_count}**")
+
+        st.dataframe(
+            contact_logs[['Date', 'Type', 'EmployeeName', 'Notes']],
+            column_config={
+                "Date": st.column_config.DatetimeColumn("Date", format="YYYY-MM-DD HH:mm"),
+            },
+            hide_index=True,
+            use_container_width=True
+        )
 
+        email_history = contact_logs[contact_logs['Type'] == 'Email']
+        if not email_history.empty:
+            st.markdown("**Email History**")
             st.dataframe(
-                contact_logs[['Date', 'Type', 'EmployeeName', 'Notes']],
+                email_history[['Date', 'EmployeeName', 'Notes']],
                 column_config={
                     "Date": st.column_config.DatetimeColumn("Date", format="YYYY-MM-DD HH:mm"),
                 },
                 hide_index=True,
                 use_container_width=True
             )
-
-            email_history = contact_logs[contact_logs['Type'] == 'Email']
-            if not email_history.empty:
-                st.markdown("**Email History**")
-                st.dataframe(
-                    email_history[['Date', 'EmployeeName', 'Notes']],
-                    column_config={
-                        "Date": st.column_config.DatetimeColumn("Date", format="YYYY-MM-DD HH:mm"),
-                    },
-                    hide_index=True,
-                    use_container_width=True
-                )
     st.markdown('</div>', unsafe_allow_html=True)
 
     # Notes / preferences and contact details edit (moved below activity)
@@ -2021,24 +4662,14 @@ def view_contact():
         e_notes = st.text_area("Notes", value=contact.get('Notes', ''))
         e_pref = st.text_area("Preferences (cadence, topics, communication)", value=contact.get('Preferences', ''))
         if st.form_submit_button("Save details"):
-            contact_idx = st.session_state['contacts'][
-                st.session_state['contacts']['ContactID'] == contact_id
-            ].index[0]
-            old_name = contact.get('Name', '')
-            st.session_state['contacts'].loc[
+            contacts_upd = st.session_state['contacts'].copy()
+            contact_idx = contacts_upd[contacts_upd['ContactID'] == contact_id].index[0]
+            contacts_upd.loc[
                 contact_idx, ['Name', 'Role', 'Email', 'Phone', 'LinkedIn', 'Notes', 'Preferences']
             ] = [e_name, e_role, e_email, e_phone, e_linkedin, e_notes, e_pref]
+            st.session_state['contacts'] = contacts_upd
+            # Logs reference the contact by ID, so a rename does not touch them
             save_to_csv('contacts')
-
-            # Keep logs aligned with updated name for this agency
-            if old_name != e_name:
-                logs_df = st.session_state.get('logs', pd.DataFrame())
-                if not logs_df.empty:
-                    mask = logs_df['ContactName'] == old_name
-                    if agency_name:
-                        mask = mask & (logs_df['AgencyName'] == agency_name)
-                    st.session_state['logs'].loc[mask, 'ContactName'] = e_name
-                    save_to_csv('logs')
             st.success("Contact details saved.")
             st.rerun()
     st.markdown('</div>', unsafe_allow_html=True)
@@ -2077,48 +4708,22 @@ def view_employee():
         uw_agencies = uw_agencies.sort_values('AgencyID').drop_duplicates(subset=['AgencyCode'], keep='first')
     agency_rows_for_later = None
     if not uw_agencies.empty and not prod_df.empty:
-        codes = uw_agencies['AgencyCode'].astype(str).str.strip()
-        prod_emp = prod_df[prod_df['AgencyCode'].astype(str).str.strip().isin(codes)].copy()
+        latest_production = get_data_store().latest_production
+        latest_prod = latest_production[latest_production['AgencyCode'].isin(uw_agencies['AgencyCode'])]
 
-        if prod_emp.empty:
+        if latest_prod.empty:
             st.info("No production data found for agencies under this employee.")
         else:
-            prod_emp['Month_dt'] = pd.to_datetime(prod_emp['Month'], format="%Y-%m", errors='coerce')
-            prod_emp = prod_emp.dropna(subset=['Month_dt'])
-            if prod_emp.empty:
-                st.info("Production rows found, but months could not be parsed.")
-            else:
-                # For each agency code, keep latest Month_dt
-                idx = prod_emp.groupby('AgencyCode')['Month_dt'].idxmax()
-                latest_prod = prod_emp.loc[idx].copy()
-                latest_prod = latest_prod.drop_duplicates(subset=['AgencyCode'])
-
-                # Merge in Office from uw_agencies, but keep a clean 'Office' column
-                latest_prod = latest_prod.merge(
-                    uw_agencies[['AgencyCode', 'AgencyName', 'Office']],
-                    on=['AgencyCode', 'AgencyName'],
-                    how='left',
-                    suffixes=('', '_uw')
-                )
-
-                # Coalesce Office / Office_uw into a single 'Office' column
-                if 'Office_uw' in latest_prod.columns:
-                    if 'Office' in latest_prod.columns:
-                        latest_prod['Office'] = latest_prod['Office_uw'].fillna(latest_prod['Office'])
-                    else:
-                        latest_prod['Office'] = latest_prod['Office_uw']
-                    latest_prod.drop(columns=['Office_uw'], inplace=True)
-
-                # Totals row
-                total_wp = latest_prod['AllYTDWP'].sum()
-                total_nb = latest_prod['AllYTDNB'].sum()
+            # Totals row
+            total_wp = latest_prod['AllYTDWP'].sum()
+            total_nb = latest_prod['AllYTDNB'].sum()
 
-                st.write(f"Agencies under this employee: **{len(latest_prod)}**")
-                st.write(f"Total YTD Written Premium (latest month per agency): **${total_wp:,.0f}**")
-                st.write(f"Total YTD New Business Count (latest month per agency): **{int(total_nb)}**")
-                st.markdown("")
+            st.write(f"Agencies under this employee: **{len(latest_prod)}**")
+            st.write(f"Total YTD Written Premium (latest month per agency): **${total_wp:,.0f}**")
+            st.write(f"Total YTD New Business Count (latest month per agency): **{int(total_nb)}**")
+            st.markdown("")
 
-                agency_rows_for_later = latest_prod.sort_values('AllYTDWP', ascending=False)
+            agency_rows_for_later = latest_prod.sort_values('AllYTDWP', ascending=False)
     elif uw_agencies.empty:
         st.info("This employee is not set as Primary Underwriter for any agencies.")
     else:
@@ -2130,21 +4735,10 @@ def view_employee():
     st.markdown('<div class="panel panel-activity">', unsafe_allow_html=True)
     st.subheader("Call/Email Activity")
 
-    logs_dt = logs.copy()
-    if not logs_dt.empty and 'Date' in logs_dt.columns:
-        logs_dt['Date'] = pd.to_datetime(logs_dt['Date'], errors='coerce')
-        logs_dt = logs_dt.dropna(subset=['Date'])
-        logs_emp = logs_dt[logs_dt['EmployeeName'] == emp_name].copy()
-        today = datetime.now().date()
-        cutoff_30 = today - timedelta(days=30)
-        logs_emp['DateOnly'] = logs_emp['Date'].dt.date
-        mask_30 = logs_emp['DateOnly'] >= cutoff_30
-        mask_ytd = logs_emp['DateOnly'] >= date(today.year, 1, 1)
-
-        calls_30 = len(logs_emp[mask_30 & (logs_emp['Type'] == 'Call')])
-        emails_30 = len(logs_emp[mask_30 & (logs_emp['Type'] == 'Email')])
-        calls_ytd = len(logs_emp[mask_ytd & (logs_emp['Type'] == 'Call')])
-        emails_ytd = len(logs_emp[mask_ytd & (logs_emp['Type'] == 'Email')])
+    if not logs.empty and 'Date' in logs.columns:
+        counts = employee_activity_counts([emp_name]).loc[emp_name]
+        calls_30, emails_30 = counts['Calls_30d'], counts['Emails_30d']
+        calls_ytd, emails_ytd = counts['Calls_YTD'], counts['Emails_YTD']
 
         c1, c2, c3, c4 = st.columns(4)
         c1.metric("Calls 30d", calls_30)
@@ -2164,32 +4758,28 @@ def view_employee():
 
     # Derived stale contacts (>90d since last contact) for this employee's agencies
     cutoff = datetime.now().date() - timedelta(days=90)
+    store = get_data_store()
+    # Older activity is not loaded; it is all past the cutoff, so only the label changes
+    never_label = f"Before {store.log_since:%Y-%m-%d}" if store.has_cold_logs else "Never"
     stale_contacts = []
     if not uw_agencies.empty:
         contacts_df = st.session_state.get('contacts', pd.DataFrame())
-        logs_df = st.session_state.get('logs', pd.DataFrame())
         agency_lookup = uw_agencies.set_index('AgencyID')['AgencyName'].to_dict()
         uw_contact_rows = contacts_df[contacts_df['AgencyID'].isin(uw_agencies['AgencyID'])] if not contacts_df.empty else pd.DataFrame()
         if not uw_contact_rows.empty:
-            for _, crow in uw_contact_rows.iterrows():
-                ag_name = agency_lookup.get(crow['AgencyID'], "")
-                if logs_df is not None and not logs_df.empty:
-                    logs_match = logs_df[
-                        (logs_df['AgencyName'] == ag_name) &
-                        (logs_df['ContactName'] == crow['Name'])
-                    ].copy()
-                    logs_match['Date'] = pd.to_datetime(logs_match['Date'], errors='coerce')
-                    logs_match = logs_match.dropna(subset=['Date'])
-                    last_date = logs_match['Date'].max().date() if not logs_match.empty else None
-                else:
-                    last_date = None
+            for contact_id, contact_name, agency_id in zip(
+                uw_contact_rows['ContactID'], uw_contact_rows['Name'], uw_contact_rows['AgencyID']
+            ):
+                ag_name = agency_lookup.get(agency_id, "")
+                last = store.last_contact.get(contact_id)
+                last_date = last[0].date() if last else None
                 if last_date is None or last_date < cutoff:
                     days_ago = (datetime.now().date() - last_date).days if last_date else None
                     stale_contacts.append({
-                        'ContactName': crow['Name'],
+                        'ContactName': contact_name,
                         'AgencyName': ag_name,
-                        'LastContact': last_date.strftime("%Y-%m-%d") if last_date else "Never",
-                        'DaysSince': days_ago if days_ago is not None else "Never"
+                        'LastContact': last_date.strftime("%Y-%m-%d") if last_date else never_label,
+                        'DaysSince': days_ago if days_ago is not None else never_label
                     })
 
     with st.expander("Add task"):
@@ -2233,10 +4823,9 @@ def view_employee():
                     t1.markdown(f"Notes: {trow['Notes']}")
                 t2.markdown(f"Status: **{trow.get('Status', 'Open')}**")
                 if t2.button("Mark done", key=f"emp_task_done_{trow['TaskID']}"):
-                    st.session_state['tasks'].loc[
-                        st.session_state['tasks']['TaskID'] == trow['TaskID'],
-                        'Status'
-                    ] = 'Done'
+                    tasks_upd = st.session_state['tasks'].copy()
+                    tasks_upd.loc[tasks_upd['TaskID'] == trow['TaskID'], 'Status'] = 'Done'
+                    st.session_state['tasks'] = tasks_upd
                     save_to_csv('tasks')
                     st.rerun()
                 if t3.button("Delete", key=f"emp_task_del_{trow['TaskID']}"):
@@ -2264,13 +4853,12 @@ def view_employee():
     if logs.empty:
         st.info("No logs recorded yet.")
     else:
-        emp_logs = logs[logs['EmployeeName'] == emp_name].copy()
+        # Rows logged under this name that resolved to no EmployeeID count too, as in the activity counts
+        emp_logs = find_logs(employee=[*employees[employees['Name'] == emp_name]['EmployeeID'], emp_name])
         emp_calls = emp_logs[emp_logs['Type'] == 'Call'].copy()
         if emp_calls.empty:
             st.info("This employee has no call activity logged yet.")
         else:
-            emp_calls['Date'] = pd.to_datetime(emp_calls['Date'], errors='coerce')
-            emp_calls = emp_calls.dropna(subset=['Date'])
             emp_calls = emp_calls.sort_values('Date', ascending=False).head(20)
             st.dataframe(
                 emp_calls[['Date', 'AgencyName', 'ContactName', 'Notes']],
@@ -2299,7 +4887,7 @@ def view_employee():
                 pc5.markdown(f"Active: {prow.get('ActiveFlag', '')}")
                 if name_clicked:
                     agencies_match = agencies[
-                        agencies['AgencyCode'].astype(str).str.strip() == str(prow.get('AgencyCode', '')).strip()
+                        agencies['AgencyCode'] == prow.get('AgencyCode', '')
                     ]
                     if not agencies_match.empty:
                         go_to_agency(agencies_match.iloc[0])
@@ -2308,7 +4896,9 @@ def view_employee():
 
 # --- ROUTER ---
 if login_gate():
+    global_search_sidebar()
     admin_sidebar()
+    show_save_conflicts()
     if st.session_state['view'] == 'company':
         view_company()
     elif st.session_state['view'] == 'office':
@@ -0,0 +1,65 @@
+"""
+Reading the rows of a production workbook's first sheet. Kept out of app.py (which runs
+the Streamlit page when imported) so that worker processes can import it.
+"""
+import io
+import time
+
+import openpyxl
+import pandas as pd
+
+# Sheet columns the parser reads: these headers, plus every column of the (duplicated) YTD families
+PRODUCTION_SHEET_COLUMNS = ('Code', 'Agency', 'Active?', 'Active')
+PRODUCTION_SHEET_PREFIXES = ('ytd wp', 'ytd nb', 'pytd wp', 'pytd nb', 'py total nb')
+
+def production_sheet_rows(uploaded_file):
+    """
+    Value tuples of the first sheet's rows, one at a time: .xlsx workbooks are streamed with
+    openpyxl in read-only mode; other formats (.xls) are read whole with pd.read_excel.
+    """
+    if str(getattr(uploaded_file, 'name', uploaded_file)).lower().endswith('.xls'):
+        raw = pd.read_excel(uploaded_file, sheet_name=0, header=None)
+        yield from raw.itertuples(index=False, name=None)
+        return
+    workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def read_production_sheet(uploaded_file):
+    """
+    The rows below the first sheet's 'Code' header row, keeping only the columns named in
+    PRODUCTION_SHEET_COLUMNS / PRODUCTION_SHEET_PREFIXES (stripped header names, duplicates
+    in sheet order). Rows are projected as they stream in, so memory follows the kept
+    columns rather than the sheet. Returns None when there is no 'Code' header.
+    """
+    rows = production_sheet_rows(uploaded_file)
+    try:
+        for row in rows:
+            if row and row[0] == 'Code':
+                header = [str(c).strip() for c in row]
+                break
+        else:
+            return None
+        keep = [
+            i for i, name in enumerate(header)
+            if name in PRODUCTION_SHEET_COLUMNS or name.lower().startswith(PRODUCTION_SHEET_PREFIXES)
+        ]
+        columns = [[] for _ in keep]
+        for row in rows:
+            width = len(row)
+            for values, i in zip(columns, keep):
+                values.append(row[i] if i < width else None)
+    finally:
+        rows.close()
+    prod = pd.DataFrame(dict(enumerate(columns)), columns=range(len(keep)), dtype=object)
+    prod.columns = [header[i] for i in keep]
+    return prod
+
+def read_production_sheet_bytes(name, data):
+    """read_production_sheet of a workbook's bytes, for process pools: (rows or None, seconds taken)."""
+    started = time.perf_counter()
+    workbook = io.BytesIO(data)
+    workbook.name = name
+    return read_production_sheet(workbook), time.perf_counter() - started
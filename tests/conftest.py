@@ -0,0 +1,45 @@
+"""
+app.py renders the Streamlit page when it runs, so tests load only its definitions: the
+source up to the INITIALIZATION section, executed as a module in a scratch directory.
+"""
+import os
+import shutil
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED_FILES = ('crm_offices.csv', 'crm_employees.csv', 'crm_agencies.csv', 'crm_contacts.csv',
+              'crm_logs.csv', 'crm_production.csv', 'crm_tasks.csv')
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    sys.path.insert(0, ROOT)
+    os.environ.update({"CRM_STORAGE": "csv", "CRM_WRITE_DELAY": "0", "CRM_WATCH_INTERVAL": "0", "CRM_DROP_DIR": ""})
+    with open(os.path.join(ROOT, "app.py")) as f:
+        source = f.read()
+    module = types.ModuleType("app")
+    module.__file__ = os.path.join(ROOT, "app.py")
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("app"))
+    try:
+        exec(compile(source[:source.index("# --- INITIALIZATION ---")], module.__file__, "exec"), module.__dict__)
+    finally:
+        os.chdir(cwd)
+    return module
+
+@pytest.fixture(autouse=True)
+def workdir(request, tmp_path, monkeypatch):
+    """Each test runs in its own empty directory, with no IDs issued yet."""
+    monkeypatch.chdir(tmp_path)
+    if "app" in request.fixturenames:
+        request.getfixturevalue("app").get_storage_backend().id_marks = None
+    return tmp_path
+
+@pytest.fixture
+def seed_files(workdir):
+    """The repository's sample crm_*.csv files, copied into the test directory."""
+    for name in SEED_FILES:
+        shutil.copy(os.path.join(ROOT, name), workdir)
+    return workdir
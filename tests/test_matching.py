@@ -0,0 +1,32 @@
+import pandas as pd
+
+def agencies(*names):
+    return pd.DataFrame({
+        'AgencyID': range(1, len(names) + 1), 'AgencyName': list(names),
+        'AgencyCode': [f"C{i}" for i in range(1, len(names) + 1)],
+    })
+
+def imported(*names):
+    return pd.DataFrame({'AgencyCode': [f"N{i}" for i in range(len(names))], 'AgencyName': list(names)})
+
+def test_exact_and_truncated_names_match(app):
+    existing = agencies('ALLIANT INSURANCE SERVICES', 'GALLAGHER', 'PACIFIC COAST BROKERS')
+    result = app.match_agencies(imported('GALLAGHER', 'ALLIANT INSURAN'), existing)
+    assert result['MatchID'].tolist() == [2, 1]
+    assert result.loc[0, 'Score'] == 1.0
+    assert result.loc[0, 'MatchCode'] == 'C2'
+    assert app.MATCH_MIN_SCORE <= result.loc[1, 'Score'] < 1.0
+
+def test_names_below_the_minimum_score_are_not_matched(app):
+    result = app.match_agencies(imported('ZENITH MUTUAL'), agencies('ALLIANT INSURANCE SERVICES', 'GALLAGHER'))
+    assert result.loc[0, 'MatchID'] == 0
+    assert result.loc[0, 'MatchName'] == ""
+
+def test_each_agency_is_proposed_for_one_row_only(app):
+    result = app.match_agencies(imported('GALLAGHER', 'GALLAGHER'), agencies('GALLAGHER'))
+    assert sorted(result['MatchID'].tolist()) == [0, 1]
+
+def test_near_matches_are_proposed_but_not_pre_selected(app):
+    result = app.match_agencies(imported('WESTERN RISK PTNRS'), agencies('WESTERN RISK PARTNERS'))
+    assert result.loc[0, 'MatchID'] == 1
+    assert app.MATCH_MIN_SCORE <= result.loc[0, 'Score'] < app.MATCH_ACCEPT_SCORE
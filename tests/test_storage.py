@@ -0,0 +1,75 @@
+import os
+
+import pandas as pd
+
+def contacts(app, *rows):
+    columns = ['ContactID', 'AgencyID', 'Name']
+    return app.apply_schema('contacts', pd.DataFrame([dict(zip(columns, row)) for row in rows], columns=columns))
+
+def log_rows(app, *dates):
+    return app.apply_schema('logs', pd.DataFrame({
+        'Date': pd.to_datetime(list(dates)), 'EmployeeID': 1, 'AgencyID': 1, 'ContactID': 0,
+        'Type': 'Call', 'Notes': 'note', 'EmployeeName': 'Ann', 'AgencyName': 'Acme', 'ContactName': '',
+    }))
+
+def test_journal_is_read_back_and_folded_into_the_table(app):
+    backend = app.FileBackend()
+    backend.write('contacts', contacts(app, (1, 1, 'Pat')))
+    backend.append('contacts', contacts(app, (2, 1, 'Lee'), (3, 2, 'Kim')))
+    assert os.path.exists('crm_contacts.journal.csv')
+    assert backend.read('contacts')['ContactID'].tolist() == [1, 2, 3]
+
+    backend.compact('contacts')
+    assert not os.path.exists('crm_contacts.journal.csv')
+    assert pd.read_csv('crm_contacts.csv')['ContactID'].tolist() == [1, 2, 3]
+    assert backend.read('contacts')['ContactID'].tolist() == [1, 2, 3]
+
+def test_journal_is_compacted_past_the_row_limit(app, monkeypatch):
+    monkeypatch.setattr(app, 'JOURNAL_COMPACT_ROWS', 2)
+    backend = app.FileBackend()
+    backend.write('contacts', contacts(app, (1, 1, 'Pat')))
+    backend.append('contacts', contacts(app, (2, 1, 'Lee')))
+    assert os.path.exists('crm_contacts.journal.csv')
+    backend.append('contacts', contacts(app, (3, 2, 'Kim')))
+    assert not os.path.exists('crm_contacts.journal.csv')
+    assert pd.read_csv('crm_contacts.csv')['ContactID'].tolist() == [1, 2, 3]
+
+def test_log_journal_is_folded_into_monthly_partitions(app):
+    backend = app.FileBackend()
+    backend.write('logs', log_rows(app, '2025-01-05', '2025-02-03'))
+    backend.append('logs', log_rows(app, '2025-02-20', '2025-03-01'))
+    backend.compact('logs')
+    assert not os.path.exists('crm_logs.journal.csv')
+    assert sorted(os.listdir('crm_logs')) == ['2025-01.csv', '2025-02.csv', '2025-03.csv']
+    assert len(pd.read_csv(os.path.join('crm_logs', '2025-02.csv'))) == 2
+    assert len(backend.read_logs()) == 4
+
+def test_legacy_log_file_is_renamed_after_migration(app):
+    log_rows(app, '2025-01-05').to_csv('crm_logs.csv', index=False)
+    assert len(app.FileBackend().read_logs()) == 1
+    assert os.listdir('crm_logs') == ['2025-01.csv']
+    assert not os.path.exists('crm_logs.csv')
+    assert os.path.exists('crm_logs.migrated.csv')
+
+def test_upsert_production_replaces_only_the_given_periods(app, seed_files):
+    backend = app.FileBackend()
+    store = app.SharedDataStore(app.load_data(), backend)
+    before = store.tables['production']
+    period = before[before['Month'] == '2025-11']
+    others = before[before['Month'] != '2025-11']
+    # One agency updated, one dropped, one added
+    new_rows = period.iloc[:-1].copy()
+    new_rows.iloc[0, new_rows.columns.get_loc('AllYTDWP')] += 100
+    new_rows = pd.concat([new_rows, period.iloc[:1].assign(AgencyCode='99999', AgencyName='NEW AGENCY')])
+
+    table, _, counts = store.upsert_production(new_rows[app.PRODUCTION_COLUMNS])
+    store.writer.flush()
+
+    assert counts == {'inserted': 1, 'updated': 1, 'removed': 1}
+    after = table[table['Month'] == '2025-11']
+    assert sorted(after['AgencyCode']) == sorted(new_rows['AgencyCode'])
+    kept = table[table['Month'] != '2025-11']
+    assert len(kept) == len(others)
+    stored = backend.read_production()
+    assert len(stored) == len(table)
+    assert '99999' in set(stored['AgencyCode'])
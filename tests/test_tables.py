@@ -0,0 +1,84 @@
+import pandas as pd
+
+def tasks(app, *rows):
+    columns = ['TaskID', 'AgencyID', 'Title', 'DueDate', 'Status', 'Owner', 'Notes']
+    return app.apply_schema('tasks', pd.DataFrame([dict(zip(columns, row)) for row in rows], columns=columns))
+
+def titles(df):
+    return dict(zip(df['TaskID'], df['Title']))
+
+def test_merge_applies_edits_to_different_rows(app):
+    base = tasks(app, (1, 1, 'call', '', 'Open', 'Ann', ''), (2, 1, 'visit', '', 'Open', 'Ann', ''))
+    mine = base.assign(Title=['call back', 'visit'])
+    current = base.assign(Title=['call', 'site visit'])
+    merged, conflicts = app.merge_table_edit('tasks', base, mine, current)
+    assert titles(merged) == {1: 'call back', 2: 'site visit'}
+    assert conflicts == []
+
+def test_merge_keeps_the_other_writers_row_on_conflict(app):
+    base = tasks(app, (1, 1, 'call', '', 'Open', 'Ann', ''))
+    mine = base.assign(Title=['mine'])
+    current = base.assign(Title=['theirs'])
+    merged, conflicts = app.merge_table_edit('tasks', base, mine, current)
+    assert titles(merged) == {1: 'theirs'}
+    assert len(conflicts) == 1
+
+def test_merge_renumbers_an_insert_whose_id_was_taken(app):
+    base = tasks(app, (1, 1, 'call', '', 'Open', 'Ann', ''))
+    mine = pd.concat([base, tasks(app, (2, 1, 'mine', '', 'Open', 'Ann', ''))], ignore_index=True)
+    current = pd.concat([base, tasks(app, (2, 1, 'theirs', '', 'Open', 'Bob', ''))], ignore_index=True)
+    merged, conflicts = app.merge_table_edit('tasks', base, mine, current)
+    assert titles(merged) == {1: 'call', 2: 'theirs', 3: 'mine'}
+    assert conflicts == []
+
+def test_merge_renumbering_skips_issued_ids(app):
+    base = tasks(app, (1, 1, 'call', '', 'Open', 'Ann', ''))
+    app.note_issued_ids(app.get_storage_backend(), 'tasks', tasks(app, (7, 1, 'deleted', '', 'Done', 'Ann', '')))
+    mine = pd.concat([base, tasks(app, (2, 1, 'mine', '', 'Open', 'Ann', ''))], ignore_index=True)
+    current = pd.concat([base, tasks(app, (2, 1, 'theirs', '', 'Open', 'Bob', ''))], ignore_index=True)
+    merged, _ = app.merge_table_edit('tasks', base, mine, current)
+    assert titles(merged)[8] == 'mine'
+
+def test_new_ids_are_not_reused_after_a_delete(app):
+    backend = app.get_storage_backend()
+    agencies = pd.DataFrame({'AgencyID': [1, 2, 3]})
+    app.note_issued_ids(backend, 'agencies', agencies)
+    assert app.get_new_id(agencies[agencies['AgencyID'] < 3], 'AgencyID') == 4
+    # The mark is stored, so it survives a restart
+    backend.id_marks = None
+    assert app.get_new_id(agencies.iloc[:0], 'AgencyID') == 4
+
+def test_employee_office_rows_keeps_reuses_and_adds_ids(app):
+    employees = pd.DataFrame({
+        'EmployeeID': [1, 2, 3], 'Name': ['Ann', 'Ann', 'Bob'], 'Office': ['SDO', 'LAF', 'SDO'],
+    })
+    # LAF is dropped and PHX added: PHX takes LAF's freed ID
+    rows = app.employee_office_rows(employees, 'Ann', ['SDO', 'PHX'])
+    assert list(zip(rows['Office'], rows['EmployeeID'])) == [('SDO', 1), ('PHX', 2)]
+    rows = app.employee_office_rows(employees, 'Ann', ['SDO', 'LAF', 'PHX'])
+    assert list(zip(rows['Office'], rows['EmployeeID'])) == [('SDO', 1), ('LAF', 2), ('PHX', 4)]
+
+def test_employee_office_rows_keeps_the_logged_id(app):
+    employees = pd.DataFrame({'EmployeeID': [1, 2], 'Name': ['Ann', 'Ann'], 'Office': ['SDO', 'LAF']})
+    rows = app.employee_office_rows(employees, 'Ann', ['PHX'])
+    assert rows['EmployeeID'].tolist() == [1]
+
+def test_resolve_log_ids_within_the_employee_offices(app):
+    tables = {
+        'agencies': pd.DataFrame({
+            'AgencyID': [1, 2, 3], 'AgencyName': ['Acme', 'Acme', 'Solo'], 'Office': ['SDO', 'LAF', 'SDO'],
+        }),
+        'employees': pd.DataFrame({'EmployeeID': [1, 2, 3], 'Name': ['Ann', 'Bob', 'Cy'], 'Office': ['SDO', 'LAF', 'PHX']}),
+        'contacts': pd.DataFrame({'ContactID': [5, 6], 'AgencyID': [2, 3], 'Name': ['Pat', 'Pat']}),
+    }
+    logs = pd.DataFrame({
+        'EmployeeID': 0, 'AgencyID': 0, 'ContactID': 0,
+        'AgencyName': ['Acme', 'Acme', 'Acme', 'Solo', 'Nowhere'],
+        'EmployeeName': ['Ann', 'Bob', 'Cy', 'Cy', 'Dee'],
+        'ContactName': ['', 'Pat', 'Pat', 'Pat', ''],
+    })
+    resolved = app.resolve_log_ids(logs, tables)
+    # Cy works in no office with an Acme, so that name stays ambiguous
+    assert resolved['AgencyID'].tolist() == [1, 2, 0, 3, 0]
+    assert resolved['ContactID'].tolist() == [0, 5, 0, 6, 0]
+    assert resolved['EmployeeID'].tolist() == [1, 2, 3, 3, 0]